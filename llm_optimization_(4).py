@@ -16,6 +16,19 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 from collections import Counter
 import itertools
+import hashlib
+import json
+import math
+import random
+import shutil
+import struct
+import tempfile
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
@@ -44,6 +57,9 @@ class SimpleBooksTokenizer:
 
     def build_vocab(self, texts):
         counter = Counter(itertools.chain.from_iterable(texts))
+        self.build_vocab_from_counter(counter)
+
+    def build_vocab_from_counter(self, counter):
         most_common = counter.most_common(self.vocab_size - 2)
         self.word2idx = {word: idx + 2 for idx, (word, _) in enumerate(most_common)}
         self.word2idx["<PAD>"] = 0
@@ -56,6 +72,154 @@ class SimpleBooksTokenizer:
     def decode(self, ids):
         return [self.idx2word[idx] for idx in ids]
 
+    def build_vocab_from_file(self, path, num_workers=None):
+        # Shards are merged in file order, so most_common breaks ties exactly like build_vocab
+        counter = Counter()
+        for partial in _map_shards(_count_shard, path, num_workers):
+            counter.update(partial)
+        self.build_vocab_from_counter(counter)
+
+    def fit_encode_file(self, path, num_workers=None, dtype=np.int32):
+        """build_vocab_from_file + encode in a single read of the file; returns [(ids, line_lengths)] per shard."""
+        scans = list(_map_shards(_scan_shard, path, num_workers))
+        counter = Counter()
+        for words, counts, _, _ in scans:
+            counter.update(dict(zip(words, counts.tolist())))
+        self.build_vocab_from_counter(counter)
+        return [self._encode_scan(scan, dtype) for scan in scans]
+
+    def iter_encode_file(self, path, num_workers=None, dtype=np.int32):
+        """Yields (ids, line_lengths) NumPy arrays per file shard, in file order."""
+        return (self._encode_scan(scan, dtype) for scan in _map_shards(_scan_shard, path, num_workers))
+
+    def _encode_scan(self, scan, dtype):
+        words, _, local_ids, lengths = scan
+        # one dict lookup per distinct word of the shard, then a vectorized gather
+        lookup = np.fromiter(map(self.word2idx.get, words, itertools.repeat(self.word2idx["<UNK>"])),
+                             dtype=dtype, count=len(words))
+        return lookup[local_ids], lengths
+
+    def encode_file(self, path, num_workers=None, dtype=np.int32):
+        parts = list(self.iter_encode_file(path, num_workers, dtype))
+        if not parts:
+            return np.empty(0, dtype=dtype), np.empty(0, dtype=np.int64)
+        return np.concatenate([ids for ids, _ in parts]), np.concatenate([lengths for _, lengths in parts])
+
+    def vocab_hash(self):
+        words = "\n".join(self.idx2word[idx] for idx in range(len(self.idx2word)))
+        return hashlib.sha1(words.encode("utf-8")).digest()
+
+    def save_vocab(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for idx in range(len(self.idx2word)):
+                f.write(self.idx2word[idx] + "\n")
+
+    def load_vocab(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            words = f.read().split("\n")[:-1]
+        self.word2idx = {word: idx for idx, word in enumerate(words)}
+        self.idx2word = dict(enumerate(words))
+
+# Batch tokenization helpers: the file is cut into newline-aligned byte ranges that are
+# counted/encoded in a process pool. Lines are split the same way as iterating a text file.
+
+
+def _file_shards(path, num_shards):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _read_shard_lines(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def _count_shard(shard):
+    return Counter(itertools.chain.from_iterable(line.split() for line in _read_shard_lines(*shard)))
+
+
+def _scan_shard(shard):
+    """Returns the shard's distinct words (first-occurrence order), their counts, per-token word index, line lengths."""
+    words = [line.split() for line in _read_shard_lines(*shard)]
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    num_tokens = int(lengths.sum())
+    # setdefault maps every token to the position of its word's first occurrence in a single C-level pass
+    first = {}
+    positions = np.fromiter(map(first.setdefault, itertools.chain.from_iterable(words), itertools.count()),
+                            dtype=np.int64, count=num_tokens)
+    first_positions = np.fromiter(first.values(), dtype=np.int64, count=len(first))
+    counts = np.bincount(positions, minlength=num_tokens)[first_positions]
+    dense = np.empty(num_tokens, dtype=np.int32)
+    dense[first_positions] = np.arange(len(first), dtype=np.int32)
+    return list(first), counts, dense[positions], lengths
+
+
+def _map_shards(fn, path, num_workers=None):
+    num_workers = num_workers or os.cpu_count() or 1
+    shards = _file_shards(path, num_workers * 4)
+    if num_workers == 1 or len(shards) <= 1:
+        yield from map(fn, shards)
+        return
+    # fork: spawn/forkserver workers cannot re-import functions defined in the notebook's __main__
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        yield from pool.map(fn, shards)
+
+
+def full_sequence_tokens(ids, lengths, seq_len):
+    # keep the first len - len % seq_len tokens of every line, as create_sequences does
+    usable = lengths - lengths % seq_len
+    line_starts = np.cumsum(lengths) - lengths
+    offset_in_line = np.arange(len(ids)) - np.repeat(line_starts, lengths)
+    return ids[offset_in_line < np.repeat(usable, lengths)]
+
+
+def bench_tokenizer(data_dir, vocab_size=15000, num_workers=None):
+    train_path = os.path.join(data_dir, "simplebooks/simplebooks-2/train.txt")
+
+    start = time.perf_counter()
+    reference = SimpleBooksTokenizer(vocab_size=vocab_size)
+    with open(train_path, "r", encoding="utf-8") as f:
+        texts = [line.strip().split() for line in f]
+    reference.build_vocab(texts)
+    reference_ids = [reference.encode(text) for text in texts]
+    reference_time = time.perf_counter() - start
+    num_tokens = sum(map(len, reference_ids))
+
+    start = time.perf_counter()
+    fast = SimpleBooksTokenizer(vocab_size=vocab_size)
+    parts = fast.fit_encode_file(train_path, num_workers)
+    ids = np.concatenate([ids for ids, _ in parts])
+    lengths = np.concatenate([lengths for _, lengths in parts])
+    fast_time = time.perf_counter() - start
+
+    assert fast.idx2word == reference.idx2word, "Batch vocab differs from build_vocab!"
+    assert lengths.tolist() == [len(text) for text in reference_ids], "Batch line split differs!"
+    assert np.array_equal(ids, np.fromiter(itertools.chain.from_iterable(reference_ids), dtype=ids.dtype,
+                                           count=num_tokens)), "Batch ids differ from encode!"
+
+    results = {
+        "tokens": num_tokens,
+        "reference_tokens_per_sec": num_tokens / reference_time,
+        "batch_tokens_per_sec": num_tokens / fast_time,
+        "speedup": reference_time / fast_time,
+    }
+    print(f"Tokenizer: {num_tokens} tokens, reference {results['reference_tokens_per_sec']:.0f} tok/s, "
+          f"batch {results['batch_tokens_per_sec']:.0f} tok/s, speedup {results['speedup']:.1f}x")
+    return results
+
+
 def load_simplebooks(data_dir, tokenizer, seq_len=60):
     """/content/simplebooks/simplebooks/simplebooks-2"""
     train_path = os.path.join(data_dir, "simplebooks/simplebooks-2/train.txt")
@@ -84,15 +248,119 @@ def load_simplebooks(data_dir, tokenizer, seq_len=60):
 
     return train_sequences, val_sequences, tokenizer
 
+# Token store: one-time tokenization into a flat token file that is memory-mapped on later runs.
+# Layout: fixed 128-byte header, then the train rows, then the valid rows, each row seq_len tokens.
+# Only full seq_len chunks of every line are written, exactly like create_sequences above.
+# The vocab is kept next to the store in `<store_path>.vocab`, one word per line in id order.
+TOKEN_STORE_MAGIC = b"SBTOKS01"
+TOKEN_STORE_HEADER = struct.Struct("<8sIII20sQQQQ")
+TOKEN_STORE_HEADER_SIZE = 128
+TOKEN_STORE_DTYPES = {2: np.uint16, 4: np.int32}
+
+
+def write_token_store_header(f, dtype, seq_len, vocab_size, vocab_hash, offsets):
+    header = TOKEN_STORE_HEADER.pack(TOKEN_STORE_MAGIC, np.dtype(dtype).itemsize, seq_len, vocab_size, vocab_hash,
+                                     offsets["train"][0], offsets["train"][1],
+                                     offsets["valid"][0], offsets["valid"][1])
+    f.seek(0)
+    f.write(header.ljust(TOKEN_STORE_HEADER_SIZE, b"\0"))
+
+
+def read_token_store_header(store_path):
+    with open(store_path, "rb") as f:
+        raw = f.read(TOKEN_STORE_HEADER.size)
+    magic, itemsize, seq_len, vocab_size, vocab_hash, train_offset, train_rows, val_offset, val_rows = \
+        TOKEN_STORE_HEADER.unpack(raw)
+    if magic != TOKEN_STORE_MAGIC:
+        raise ValueError(f"{store_path} is not a token store")
+    return {
+        "dtype": TOKEN_STORE_DTYPES[itemsize],
+        "seq_len": seq_len,
+        "vocab_size": vocab_size,
+        "vocab_hash": vocab_hash,
+        "offsets": {"train": (train_offset, train_rows), "valid": (val_offset, val_rows)},
+    }
+
+
+def build_token_store(data_dir, tokenizer, store_path, seq_len=60, dtype=np.int32, num_workers=None):
+    # int32 rows are served as zero-copy tensors; uint16 halves the file but is widened on read
+    train_path = os.path.join(data_dir, "simplebooks/simplebooks-2/train.txt")
+    val_path = os.path.join(data_dir, "simplebooks/simplebooks-2/valid.txt")
+
+    train_parts = tokenizer.fit_encode_file(train_path, num_workers, dtype)
+    assert len(tokenizer.word2idx) <= np.iinfo(dtype).max + 1, "Vocab does not fit into the token store dtype!"
+    assert len(tokenizer.word2idx) <= tokenizer.vocab_size, "Token indices exceed vocab_size!"
+
+    offsets = {}
+    with open(store_path, "wb") as out:
+        out.write(b"\0" * TOKEN_STORE_HEADER_SIZE)
+        for split, path in (("train", train_path), ("valid", val_path)):
+            start = out.tell()
+            parts = train_parts if split == "train" else tokenizer.iter_encode_file(path, num_workers, dtype)
+            for ids, lengths in parts:
+                full_sequence_tokens(ids, lengths, seq_len).tofile(out)
+            rows = (out.tell() - start) // (np.dtype(dtype).itemsize * seq_len)
+            offsets[split] = (start, rows)
+        write_token_store_header(out, dtype, seq_len, tokenizer.vocab_size, tokenizer.vocab_hash(), offsets)
+
+    tokenizer.save_vocab(store_path + ".vocab")
+    return store_path
+
+
+class TokenStoreDataset(Dataset):
+    def __init__(self, store_path, split="train"):
+        header = read_token_store_header(store_path)
+        offset, rows = header["offsets"][split]
+        self.seq_len = header["seq_len"]
+        self.vocab_size = header["vocab_size"]
+        if rows:
+            # copy-on-write keeps the mapping writable for torch without ever touching the file
+            self.tokens = np.memmap(store_path, dtype=header["dtype"], mode="c",
+                                    offset=offset, shape=(rows, self.seq_len))
+        else:
+            self.tokens = np.empty((0, self.seq_len), dtype=header["dtype"])
+        if self.tokens.dtype == np.int32:
+            self.sequences = torch.from_numpy(self.tokens)
+        else:
+            self.sequences = None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, idx):
+        if self.sequences is not None:
+            return self.sequences[idx]
+        return torch.from_numpy(self.tokens[idx].astype(np.int32))
+
+    def as_tensor(self):
+        if self.sequences is not None:
+            return self.sequences
+        return torch.from_numpy(self.tokens.astype(np.int32))
+
+
+def load_token_store(store_path, tokenizer):
+    header = read_token_store_header(store_path)
+    tokenizer.vocab_size = header["vocab_size"]
+    tokenizer.load_vocab(store_path + ".vocab")
+    if tokenizer.vocab_hash() != header["vocab_hash"]:
+        raise ValueError(f"Vocab next to {store_path} does not match the store header")
+    return TokenStoreDataset(store_path, "train"), TokenStoreDataset(store_path, "valid"), tokenizer
+
 
 vocab_size = 15000
 seq_len=60
 tokenizer = SimpleBooksTokenizer(vocab_size=vocab_size)
-train_sequences, val_sequences, tokenizer = load_simplebooks(dataset_dir, tokenizer)
+token_store_path = os.path.join(dataset_dir, f"simplebooks-2.vocab{vocab_size}.seq{seq_len}.tok")
+if not os.path.exists(token_store_path):
+    build_token_store(dataset_dir, tokenizer, token_store_path, seq_len)
+train_store, val_store, tokenizer = load_token_store(token_store_path, tokenizer)
+train_sequences, val_sequences = train_store.sequences, val_store.sequences
 
 print(f"Train Sequences: {len(train_sequences)}")
 print(f"Validation Sequences: {len(val_sequences)}")
 
+# bench_tokenizer(dataset_dir, vocab_size)
+
 class SimpleBooksDataset(Dataset):
     def __init__(self, sequences, seq_len, vocab_size):
         self.sequences = sequences
@@ -109,22 +377,250 @@ class SimpleBooksDataset(Dataset):
         sequence = torch.clamp(sequence, 0, self.vocab_size - 1)
         return sequence
 
-max_token_idx = max(itertools.chain.from_iterable(train_sequences))
+    def as_tensor(self):
+        sequences = torch.tensor(self.sequences, dtype=torch.long)
+        return sequences.clamp_(0, self.vocab_size - 1)
+
+
+class EvalSet:
+    """A fixed, deterministic set of validation batches materialised on device once.
+
+    max_batches picks a fixed-seed subset of rows (sorted, so the order never changes) for cheap
+    "eval every N steps" curves; None keeps the whole split. num_replicas/rank shard the rows for DDP.
+    """
+
+    def __init__(self, sequences, batch_size=256, max_batches=None, device=None, seed=0, num_replicas=1, rank=0):
+        data = sequences.as_tensor() if hasattr(sequences, "as_tensor") else torch.as_tensor(sequences)
+        if max_batches is not None and max_batches * batch_size < len(data):
+            rows = torch.randperm(len(data), generator=torch.Generator().manual_seed(seed))
+            data = data[rows[:max_batches * batch_size].sort().values]
+        data = data[rank::num_replicas]
+        self.num_rows = len(data)
+        self.batches = list(data.to(device).long().split(batch_size))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+class SequenceBatchLoader:
+    """Serves whole [batch_size, seq_len] batches from one pre-built 2-D token tensor.
+
+    Each batch is a single index_select (straight into pinned memory when pin_memory=True)
+    followed by an optional non_blocking copy to `device`. With prefetch > 0 a background
+    thread keeps up to `prefetch` batches ready while the model runs.
+
+    With num_replicas > 1 it behaves like DistributedSampler: every rank draws the same
+    permutation from seed + epoch (see set_epoch), pads it to a multiple of num_replicas and
+    keeps every num_replicas-th row starting at rank, so all ranks run the same number of steps.
+    """
+
+    _END = object()
+
+    def __init__(self, sequences, batch_size=32, shuffle=True, drop_last=False,
+                 pin_memory=False, device=None, prefetch=0, generator=None,
+                 num_replicas=1, rank=0, seed=0):
+        self.sequences = sequences.as_tensor() if hasattr(sequences, "as_tensor") else torch.as_tensor(sequences)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.device = device
+        self.prefetch = prefetch
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_rows(self):
+        return (len(self.sequences) + self.num_replicas - 1) // self.num_replicas
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_rows() // self.batch_size
+        return (self.num_rows() + self.batch_size - 1) // self.batch_size
+
+    def batch_indices(self):
+        num_rows = len(self.sequences)
+        generator = self.generator
+        if self.num_replicas > 1:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(num_rows, generator=generator)
+        else:
+            order = torch.arange(num_rows)
+        if self.num_replicas > 1:
+            padding = self.num_rows() * self.num_replicas - num_rows
+            order = torch.cat([order, order[:padding]])[self.rank::self.num_replicas]
+        batches = list(order.split(self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def load_batch(self, idx):
+        if self.pin_memory:
+            batch = torch.empty((len(idx), self.sequences.size(1)), dtype=self.sequences.dtype, pin_memory=True)
+            torch.index_select(self.sequences, 0, idx, out=batch)
+        else:
+            batch = self.sequences.index_select(0, idx)
+        if self.device is not None:
+            batch = batch.to(self.device, non_blocking=self.pin_memory)
+        return batch
+
+    def __iter__(self):
+        batches = self.batch_indices()
+        if not self.prefetch:
+            return map(self.load_batch, batches)
+        return self._prefetch(batches)
+
+    def _prefetch(self, batches):
+        ready = queue.Queue(self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for idx in batches:
+                    if not put(self.load_batch(idx)):
+                        return
+            except BaseException as e:
+                put(e)
+            put(self._END)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is self._END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+
+max_token_idx = int(train_sequences.max())
 print(f"Maximum token index in train_sequences: {max_token_idx}")
 assert max_token_idx < vocab_size, "Token indices exceed vocab_size!"
 
-train_dataset = SimpleBooksDataset(train_sequences, seq_len, vocab_size)
-train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
+train_dataset = train_store
+train_loader = SequenceBatchLoader(train_dataset, batch_size=32, shuffle=True,
+                                   pin_memory=torch.cuda.is_available(),
+                                   device='cuda' if torch.cuda.is_available() else 'cpu',
+                                   prefetch=2)
 
-val_dataset = SimpleBooksDataset(train_sequences, seq_len, vocab_size)
-val_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
+# validation runs on the held-out valid split in a fixed order; eval_set is the same data kept on device
+val_dataset = val_store
+val_loader = SequenceBatchLoader(val_dataset, batch_size=256, shuffle=False,
+                                 device='cuda' if torch.cuda.is_available() else 'cpu')
+eval_set = EvalSet(val_dataset, batch_size=256, device='cuda' if torch.cuda.is_available() else 'cpu')
 
 import time
+import resource
+import contextlib
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def reset_peak_memory(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    # on CPU this is the process-wide peak RSS, so it only ever grows between calls
+    if str(device).startswith("cuda"):
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize(device)
+
+
+class KVCache:
+    """Per-layer key/value cache, preallocated for max_len positions on the first append."""
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.length = 0
+        self.k = None
+        self.v = None
+
+    def append(self, k, v):
+        if self.k is None:
+            shape = (k.size(0), k.size(1), self.max_len, k.size(3))
+            self.k = k.new_empty(shape)
+            self.v = v.new_empty(shape)
+        end = self.length + k.size(2)
+        self.k[:, :, self.length:end] = k
+        self.v[:, :, self.length:end] = v
+        self.length = end
+        return self.k[:, :, :end], self.v[:, :, :end]
+
+
+class CausalSelfAttention(nn.Module):
+    """Batch-first causal self-attention on F.scaled_dot_product_attention.
+
+    With mup_attn=True the attention logits are scaled by attn_mult / head_dim instead of
+    1 / sqrt(head_dim), as μP requires for width transfer.
+    """
+
+    def __init__(self, hidden_size, num_heads, dropout=0.1, mup_attn=False, attn_mult=1.0):
+        super(CausalSelfAttention, self).__init__()
+        assert hidden_size % num_heads == 0, "hidden_size must be divisible by num_heads"
+        self.num_heads = num_heads
+        self.head_dim = hidden_size // num_heads
+        self.dropout = dropout
+        self.scale = attn_mult / self.head_dim if mup_attn else self.head_dim ** -0.5
+        self.qkv = nn.Linear(hidden_size, 3 * hidden_size)
+        self.proj = nn.Linear(hidden_size, hidden_size)
+
+    def forward(self, x, attn_mask=None, kv_cache=None):
+        batch_size, seq_len, hidden_size = x.shape
+        q, k, v = self.qkv(x).view(batch_size, seq_len, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        past_len = 0
+        if kv_cache is not None:
+            past_len = kv_cache.length
+            k, v = kv_cache.append(k, v)
+        # SDPA's is_causal is aligned top-left, which is only right without cached keys
+        assert attn_mask is not None or past_len == 0 or seq_len == 1, "extending a cache needs an explicit attn_mask"
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                             dropout_p=self.dropout if self.training else 0.0,
+                                             is_causal=attn_mask is None and past_len == 0, scale=self.scale)
+        out = out.transpose(1, 2).reshape(batch_size, seq_len, hidden_size)
+        return self.proj(out)
+
 
 class GPT2Block(nn.Module):
-    def __init__(self, hidden_size, num_heads, ff_hidden_size, dropout=0.1):
+    def __init__(self, hidden_size, num_heads, ff_hidden_size, dropout=0.1, attn_impl="mha", mup_attn=False):
         super(GPT2Block, self).__init__()
-        self.attn = nn.MultiheadAttention(hidden_size, num_heads, dropout=dropout)
+        self.attn_impl = attn_impl
+        if attn_impl == "sdpa":
+            self.attn = CausalSelfAttention(hidden_size, num_heads, dropout=dropout, mup_attn=mup_attn)
+        elif attn_impl == "mha":
+            self.attn = nn.MultiheadAttention(hidden_size, num_heads, dropout=dropout)
+        else:
+            raise ValueError(f"Unknown attn_impl: {attn_impl}")
         self.ln1 = nn.LayerNorm(hidden_size)
         self.ff = nn.Sequential(
             nn.Linear(hidden_size, ff_hidden_size),
@@ -134,8 +630,11 @@ class GPT2Block(nn.Module):
         )
         self.ln2 = nn.LayerNorm(hidden_size)
 
-    def forward(self, x, attn_mask=None):
-        attn_output, _ = self.attn(x, x, x, attn_mask=attn_mask)
+    def forward(self, x, attn_mask=None, kv_cache=None):
+        if self.attn_impl == "sdpa":
+            attn_output = self.attn(x, attn_mask=attn_mask, kv_cache=kv_cache)
+        else:
+            attn_output, _ = self.attn(x, x, x, attn_mask=attn_mask)
         x = self.ln1(x + attn_output)
 
         ff_output = self.ff(x)
@@ -144,18 +643,111 @@ class GPT2Block(nn.Module):
         return x
 
 
+def chunked_cross_entropy(head, hidden, targets, chunk_size=None, ignore_index=-100):
+    """Mean cross-entropy of head(hidden) against targets, chunk_size positions at a time.
+
+    Every chunk's logits are recomputed in backward, so the full [B, T, vocab] logits tensor is
+    never held. head is called as a module, so MuReadout's output multiplier is applied as usual.
+    """
+    hidden = hidden.reshape(-1, hidden.size(-1))
+    targets = targets.reshape(-1)
+    if chunk_size is None:
+        return F.cross_entropy(head(hidden), targets, ignore_index=ignore_index)
+
+    def chunk_loss(h, t):
+        return F.cross_entropy(head(h), t, ignore_index=ignore_index, reduction="sum")
+
+    total = hidden.new_zeros((), dtype=torch.float32)
+    for h, t in zip(hidden.split(chunk_size), targets.split(chunk_size)):
+        total = total + checkpoint(chunk_loss, h, t, use_reentrant=False)
+    return total / (targets != ignore_index).sum().clamp(min=1)
+
+
+# build_vocab numbers words by frequency (after <PAD>/<UNK>), which is the order adaptive softmax needs:
+# ids below the first cutoff form the full-size head, rarer ids go to smaller tail clusters
+ADAPTIVE_CUTOFFS = (2000, 6000)
+# a tied readout starts from the embedding, so N(0, 1) would give logits of std ~sqrt(hidden) (~50 at 2560)
+# and an initial loss in the hundreds; GPT-2's 0.02 keeps them O(1) and is width-independent, as μP needs
+TIED_EMB_STD = 0.02
+
+
+def adaptive_cutoffs(vocab_size, cutoffs=ADAPTIVE_CUTOFFS):
+    kept = [cutoff for cutoff in cutoffs if cutoff < vocab_size - 1]
+    if not kept:
+        raise ValueError(f"No adaptive softmax cutoff in {tuple(cutoffs)} is below vocab_size - 1 = {vocab_size - 1}; "
+                         f"pass cutoffs= smaller than the vocab")
+    return kept
+
+
+def head_loss(head, hidden, targets, chunk_size=None):
+    # targets are the input ids themselves; shift so that position t predicts token t + 1
+    hidden, targets = hidden[:, :-1], targets[:, 1:]
+    if isinstance(head, nn.AdaptiveLogSoftmaxWithLoss):
+        # only the clusters the targets fall into are evaluated, so there is nothing to chunk
+        return head(hidden.reshape(-1, hidden.size(-1)), targets.reshape(-1)).loss
+    return chunked_cross_entropy(head, hidden, targets, chunk_size)
+
+
+def head_logits(head, hidden):
+    if isinstance(head, nn.AdaptiveLogSoftmaxWithLoss):
+        # full log-probabilities; cross-entropy, softmax and argmax treat them exactly like logits
+        return head.log_prob(hidden.reshape(-1, hidden.size(-1))).view(*hidden.shape[:-1], -1)
+    return head(hidden)
+
+
+def uses_adaptive_head(model):
+    model = getattr(model, "module", model)
+    return isinstance(getattr(model, "head", None), nn.AdaptiveLogSoftmaxWithLoss)
+
+
+def run_blocks(blocks, x, grad_checkpoint=False):
+    # with grad_checkpoint only block inputs are kept; each block is recomputed in backward
+    for block in blocks:
+        if grad_checkpoint:
+            x = checkpoint(block, x, use_reentrant=False)
+        else:
+            x = block(x)
+    return x
+
+
+def accumulation_steps(effective_batch_size, micro_batch_size):
+    assert effective_batch_size % micro_batch_size == 0, "effective batch must be a multiple of the micro batch"
+    return effective_batch_size // micro_batch_size
+
+
+def compute_loss(model, batch, criterion, vocab_size, loss_chunk_size=None):
+    # next-token targets: position t is scored against token t + 1, the last position has no target.
+    # loss_chunk_size=None keeps the original full-logits criterion path; adaptive heads never build full logits
+    if loss_chunk_size is None and not uses_adaptive_head(model):
+        logits = model(batch)
+        return criterion(logits[:, :-1].reshape(-1, vocab_size), batch[:, 1:].reshape(-1))
+    return model(batch, targets=batch, loss_chunk_size=loss_chunk_size)
+
+
 class GPT2Model(nn.Module):
-    def __init__(self, vocab_size, max_seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout=0.1):
+    def __init__(self, vocab_size, max_seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout=0.1,
+                 attn_impl="mha", grad_checkpoint=False, tie_embeddings=False, head_type="linear",
+                 cutoffs=ADAPTIVE_CUTOFFS):
         super(GPT2Model, self).__init__()
+        self.grad_checkpoint = grad_checkpoint
         self.token_emb = nn.Embedding(vocab_size, hidden_size)
         self.pos_emb = nn.Embedding(max_seq_len, hidden_size)
         self.blocks = nn.ModuleList([
-            GPT2Block(hidden_size, num_heads, ff_hidden_size, dropout) for _ in range(num_layers)
+            GPT2Block(hidden_size, num_heads, ff_hidden_size, dropout, attn_impl) for _ in range(num_layers)
         ])
         self.ln_f = nn.LayerNorm(hidden_size)
-        self.head = nn.Linear(hidden_size, vocab_size)
+        # tie_embeddings reuses token_emb as the readout weight; head_type="adaptive" swaps the
+        # vocab-wide readout for a frequency-bucketed adaptive softmax
+        assert not (tie_embeddings and head_type == "adaptive"), "Adaptive softmax head cannot be tied!"
+        if head_type == "adaptive":
+            self.head = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, vocab_size, adaptive_cutoffs(vocab_size, cutoffs))
+        else:
+            self.head = nn.Linear(hidden_size, vocab_size, bias=not tie_embeddings)
+            if tie_embeddings:
+                nn.init.normal_(self.token_emb.weight, std=TIED_EMB_STD)
+                self.head.weight = self.token_emb.weight
 
-    def forward(self, x):
+    def forward(self, x, targets=None, loss_chunk_size=None):
         # print("x: ", x.size(), x, x.max())
         seq_len = x.size(1)
         # print("SEQ_LEN: ", seq_len)
@@ -167,72 +759,657 @@ class GPT2Model(nn.Module):
         pos_emb = self.pos_emb(positions)
         # print("pos_emb: ", pos_emb.size(), pos_emb)
         x = emb + pos_emb
-        for block in self.blocks:
-            x = block(x)
+        x = run_blocks(self.blocks, x, self.grad_checkpoint and self.training)
 
         x = self.ln_f(x)
-        logits = self.head(x)
+        if targets is not None:
+            return head_loss(self.head, x, targets, loss_chunk_size)
+        logits = head_logits(self.head, x)
         return logits
 
 
-def train(model, train_loader, val_loader, optimizer, criterion, epochs, writer, tag, device='cuda' if torch.cuda.is_available() else 'cpu'):
+def saved_activation_mb(fn):
+    # bytes autograd keeps for backward, deduplicated by storage; device independent
+    seen = {}
+
+    def pack(t):
+        seen[(t.untyped_storage().data_ptr(), t.device)] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(seen.values()) / 2 ** 20
+
+
+def bench_attention(hidden_sizes=(64, 128, 256, 512, 1024, 2560), num_heads=4, batch_size=32, seq_len=60,
+                    steps=10, device='cuda' if torch.cuda.is_available() else 'cpu'):
+    results = []
+    for hidden_size in hidden_sizes:
+        for attn_impl in ("mha", "sdpa"):
+            block = GPT2Block(hidden_size, num_heads, 4 * hidden_size, dropout=0.1, attn_impl=attn_impl).to(device)
+            x = torch.randn(batch_size, seq_len, hidden_size, device=device, requires_grad=True)
+            block(x).sum().backward()
+            # CPU peak RSS never goes down, so compare what autograd saves; CUDA peaks are reset per case
+            out, saved_mb = saved_activation_mb(lambda: block(x).sum())
+            out.backward()
+            reset_peak_memory(device)
+            start = time.perf_counter()
+            for _ in range(steps):
+                block(x).sum().backward()
+            synchronize(device)
+            step_ms = (time.perf_counter() - start) / steps * 1000
+            peak_mb = peak_memory_mb(device) if torch.device(device).type == "cuda" else None
+            results.append({"hidden_size": hidden_size, "attn_impl": attn_impl, "step_ms": step_ms,
+                            "saved_activation_mb": saved_mb, "peak_memory_mb": peak_mb})
+            print(f"hs{hidden_size} {attn_impl}: {step_ms:.2f} ms/step, saved activations {saved_mb:.1f} MB")
+            del block, x
+    return results
+
+# bench_attention()
+
+
+def bench_chunked_loss(hidden_size=1024, vocab_size=15000, batch_size=32, seq_len=60, chunk_sizes=(None, 1920, 480),
+                       steps=5, device='cuda' if torch.cuda.is_available() else 'cpu'):
+    torch.manual_seed(0)
+    head = nn.Linear(hidden_size, vocab_size).to(device)
+    hidden = torch.randn(batch_size, seq_len, hidden_size, device=device, requires_grad=True)
+    targets = torch.randint(0, vocab_size, (batch_size, seq_len), device=device)
+
+    results, reference = [], None
+    for chunk_size in chunk_sizes:
+        head.zero_grad()
+        hidden.grad = None
+        reset_peak_memory(device)
+        loss, saved_mb = saved_activation_mb(lambda: chunked_cross_entropy(head, hidden, targets, chunk_size))
+        loss.backward()
+        start = time.perf_counter()
+        for _ in range(steps):
+            chunked_cross_entropy(head, hidden, targets, chunk_size).backward()
+        synchronize(device)
+        step_ms = (time.perf_counter() - start) / steps * 1000
+        if reference is None:
+            reference = loss.item()
+        results.append({"chunk_size": chunk_size, "loss": loss.item(), "loss_diff": abs(loss.item() - reference),
+                         "step_ms": step_ms, "saved_activation_mb": saved_mb,
+                         "peak_memory_mb": peak_memory_mb(device)})
+        print(f"chunk {chunk_size}: loss {loss.item():.6f}, {step_ms:.2f} ms/step, "
+              f"saved activations {saved_mb:.1f} MB, peak {results[-1]['peak_memory_mb']:.1f} MB")
+    return results
+
+# bench_chunked_loss()
+
+
+class MetricsLogger:
+    """Keeps per-step losses on device and hands them to the SummaryWriter from a background thread.
+
+    Losses are stacked and copied to the host once every flush_every steps; on CUDA the copy is
+    non_blocking into pinned memory and the writer thread waits on a CUDA event, so the training
+    loop itself never syncs. Tags match what train() always wrote: {tag}/batch_loss per step.
+    """
+
+    def __init__(self, writer, tag, flush_every=100):
+        self.writer = writer
+        self.tag = tag
+        self.flush_every = flush_every
+        self.pending_losses = []
+        self.pending_steps = []
+        self.epoch_sum = None
+        self.epoch_steps = 0
+        self.events = queue.Queue()
+        self.worker = threading.Thread(target=self._write_events, daemon=True)
+        self.worker.start()
+
+    def log_step(self, loss, step):
+        loss = loss.detach().float()
+        self.pending_losses.append(loss)
+        self.pending_steps.append(step)
+        self.epoch_sum = loss if self.epoch_sum is None else self.epoch_sum + loss
+        self.epoch_steps += 1
+        if len(self.pending_losses) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_losses:
+            return
+        values = torch.stack(self.pending_losses)
+        done = None
+        if values.is_cuda:
+            host = torch.empty(values.shape, dtype=values.dtype, pin_memory=True)
+            host.copy_(values, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record(torch.cuda.current_stream(values.device))
+            values = host
+        self.events.put(("batch_loss", self.pending_steps, values, done))
+        self.pending_losses, self.pending_steps = [], []
+
+    def epoch_loss(self):
+        # the one blocking sync per epoch
+        self.flush()
+        value = (self.epoch_sum / max(self.epoch_steps, 1)).item() if self.epoch_sum is not None else 0.0
+        self.epoch_sum, self.epoch_steps = None, 0
+        return value
+
+    def add_scalar(self, tag, value, step):
+        self.events.put(("scalar", tag, value, step))
+
+    def epoch_state(self):
+        loss_sum = self.epoch_sum.item() if self.epoch_sum is not None else 0.0
+        return loss_sum, self.epoch_steps
+
+    def restore_epoch_state(self, loss_sum, steps, device):
+        self.epoch_sum = torch.tensor(loss_sum, device=device) if steps else None
+        self.epoch_steps = steps
+
+    def close(self):
+        self.flush()
+        self.events.put(None)
+        self.worker.join()
+
+    def _write_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            if event[0] == "batch_loss":
+                _, steps, values, done = event
+                if done is not None:
+                    done.synchronize()
+                for step, value in zip(steps, values.tolist()):
+                    self.writer.add_scalar(f"{self.tag}/batch_loss", value, step)
+            else:
+                _, tag, value, step = event
+                self.writer.add_scalar(tag, value, step)
+
+
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None:
+        torch.cuda.set_rng_state_all(state["cuda"])
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+
+
+class AsyncCheckpointer:
+    """Periodic checkpoints of model, optimizer, RNG and data position, written by a background thread.
+
+    The training thread only snapshots the states to CPU; serialisation happens in the background,
+    one checkpoint in flight at a time. A checkpoint is a directory step_<n>/ with the model state
+    split into shard files of at most shard_mb, optimizer.pt (MuAdam param groups included),
+    trainer.pt, base_shapes.bsh for μP models and meta.json. It is written under a temporary
+    name and renamed when complete, then recorded in <ckpt_dir>/latest. Under DDP every rank calls
+    save; rank 0 writes the unwrapped model and one RNG state per rank.
+    """
+
+    def __init__(self, ckpt_dir, every_n_steps=1000, keep=2, shard_mb=512):
+        self.ckpt_dir = ckpt_dir
+        self.every_n_steps = every_n_steps
+        self.keep = keep
+        self.shard_bytes = shard_mb * 2 ** 20
+        self.worker = None
+        self.error = None
+        os.makedirs(ckpt_dir, exist_ok=True)
+
+    def maybe_save(self, global_step, *args, **kwargs):
+        if self.every_n_steps and global_step % self.every_n_steps == 0:
+            self.save(global_step, *args, **kwargs)
+
+    def save(self, global_step, model, optimizer, epoch, batch_idx, epoch_rng, scaler=None, metrics=None):
+        self.wait()
+        rng = get_rng_state()
+        if dist.is_available() and dist.is_initialized():
+            # every rank calls save at the same step; rank 0 writes all ranks' RNG so resumed dropout matches
+            rng_states = [None] * dist.get_world_size()
+            dist.all_gather_object(rng_states, rng)
+            if dist.get_rank() != 0:
+                return
+            rng = rng_states
+        # DDP's wrapper would prefix every name with "module."
+        model = getattr(model, "module", model)
+        loss_sum, loss_steps = metrics.epoch_state() if metrics is not None else (0.0, 0)
+        shards, shard, shard_size = [], {}, 0
+        for name, tensor in model.state_dict().items():
+            size = tensor.numel() * tensor.element_size()
+            if shard and shard_size + size > self.shard_bytes:
+                shards.append(shard)
+                shard, shard_size = {}, 0
+            shard[name] = _to_cpu(tensor)
+            shard_size += size
+        shards.append(shard)
+        trainer = {
+            "global_step": global_step,
+            "epoch": epoch,
+            "batch_idx": batch_idx,
+            "epoch_rng": epoch_rng,
+            "rng": rng,
+            "scaler": scaler.state_dict() if scaler is not None and scaler.is_enabled() else None,
+            "epoch_loss_sum": loss_sum,
+            "epoch_loss_steps": loss_steps,
+        }
+        infshapes = all(hasattr(p, "infshape") for p in model.parameters())
+        self.worker = threading.Thread(target=self._write_or_record,
+                                       args=(global_step, shards, _to_cpu(optimizer.state_dict()), trainer,
+                                             model if infshapes else None))
+        self.worker.start()
+
+    def wait(self):
+        # a failed background write (disk full, permissions) surfaces here, at the next save or at the end of train()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Background checkpoint write failed") from error
+
+    def _write_or_record(self, *args):
+        try:
+            self._write(*args)
+        except BaseException as e:
+            self.error = e
+
+    def _write(self, global_step, shards, optimizer_state, trainer, mup_model):
+        name = f"step_{global_step:09d}"
+        final_dir = os.path.join(self.ckpt_dir, name)
+        tmp_dir = final_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        shard_files = [f"model-{i:05d}-of-{len(shards):05d}.pt" for i in range(len(shards))]
+        for shard_file, shard in zip(shard_files, shards):
+            torch.save(shard, os.path.join(tmp_dir, shard_file))
+        torch.save(optimizer_state, os.path.join(tmp_dir, "optimizer.pt"))
+        torch.save(trainer, os.path.join(tmp_dir, "trainer.pt"))
+        if mup_model is not None:
+            from mup import save_base_shapes
+            save_base_shapes(mup_model, os.path.join(tmp_dir, "base_shapes.bsh"))
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"global_step": global_step, "epoch": trainer["epoch"], "batch_idx": trainer["batch_idx"],
+                       "shards": shard_files, "base_shapes": mup_model is not None}, f)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        with open(os.path.join(self.ckpt_dir, "latest.tmp"), "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(os.path.join(self.ckpt_dir, "latest.tmp"), os.path.join(self.ckpt_dir, "latest"))
+        checkpoints = sorted(d for d in os.listdir(self.ckpt_dir) if d.startswith("step_") and not d.endswith(".tmp"))
+        for old in checkpoints[:-self.keep]:
+            shutil.rmtree(os.path.join(self.ckpt_dir, old), ignore_errors=True)
+
+
+def latest_checkpoint(ckpt_dir):
+    latest = os.path.join(ckpt_dir, "latest")
+    if not os.path.exists(latest):
+        return None
+    with open(latest, "r", encoding="utf-8") as f:
+        return os.path.join(ckpt_dir, f.read().strip())
+
+
+def load_checkpoint(path, model, optimizer=None, scaler=None, map_location="cpu"):
+    # a μP model must already have its base shapes set, e.g. set_base_shapes(model, f"{path}/base_shapes.bsh")
+    with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    state = {}
+    for shard_file in meta["shards"]:
+        state.update(torch.load(os.path.join(path, shard_file), map_location=map_location))
+    getattr(model, "module", model).load_state_dict(state)
+    if optimizer is not None:
+        optimizer.load_state_dict(torch.load(os.path.join(path, "optimizer.pt"), map_location=map_location))
+    trainer = torch.load(os.path.join(path, "trainer.pt"), weights_only=False)
+    if isinstance(trainer["rng"], list):
+        # saved under DDP: one RNG state per rank
+        trainer["rng"] = trainer["rng"][dist.get_rank() if dist.is_available() and dist.is_initialized() else 0]
+    if scaler is not None and trainer["scaler"] is not None:
+        scaler.load_state_dict(trainer["scaler"])
+    return trainer
+
+
+def set_loader_epoch(loader, epoch):
+    # SequenceBatchLoader and DataLoader(sampler=DistributedSampler) reshuffle per epoch this way
+    for target in (loader, getattr(loader, "sampler", None)):
+        if hasattr(target, "set_epoch"):
+            target.set_epoch(epoch)
+
+
+def all_reduce_sum(value, device):
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    tensor = torch.tensor(float(value), dtype=torch.float64 if torch.device(device).type == "cpu" else torch.float32,
+                          device=device)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+def all_reduce_mean(value, device):
+    if not (dist.is_available() and dist.is_initialized()):
+        return value
+    return all_reduce_sum(value, device) / dist.get_world_size()
+
+
+AMP_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast_context(device, precision="fp32"):
+    amp_dtype = AMP_DTYPES[precision]
+    return torch.autocast(torch.device(device).type, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+
+PROFILE_SCHEDULE = {"wait": 1, "warmup": 1, "active": 3, "repeat": 1}
+
+
+@contextlib.contextmanager
+def profile_range(name, nvtx=False):
+    # shows up as a block in the Chrome trace and, with nvtx, as a range in Nsight Systems
+    with torch.profiler.record_function(name):
+        if nvtx:
+            torch.cuda.nvtx.range_push(name)
+        try:
+            yield
+        finally:
+            if nvtx:
+                torch.cuda.nvtx.range_pop()
+
+
+def ranged_batches(loader, ranges):
+    # time spent waiting on the loader itself, not only the host-to-device copy
+    batches = iter(loader)
+    while True:
+        with ranges("data_load"):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        yield batch
+
+
+def export_profile(profile_dir, device):
+    on_cuda = torch.device(device).type == "cuda"
+    sort_by = "self_cuda_time_total" if on_cuda else "self_cpu_time_total"
+    rank = f".rank{dist.get_rank()}" if dist.is_available() and dist.is_initialized() else ""
+
+    def on_trace_ready(prof):
+        os.makedirs(profile_dir, exist_ok=True)
+        name = f"profile.step{prof.step_num}{rank}"
+        prof.export_chrome_trace(os.path.join(profile_dir, f"{name}.trace.json"))
+        with open(os.path.join(profile_dir, f"{name}.ops.txt"), "w", encoding="utf-8") as f:
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+        print(f"Profile written to {profile_dir}/{name}.*")
+
+    return on_trace_ready
+
+
+def make_profiler(profile, profile_dir, device):
+    schedule = dict(PROFILE_SCHEDULE, **(profile if isinstance(profile, dict) else {}))
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(device).type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities, schedule=torch.profiler.schedule(**schedule),
+                                  on_trace_ready=export_profile(profile_dir, device), record_shapes=True,
+                                  profile_memory=True)
+
+
+def train(model, train_loader, val_loader, optimizer, criterion, epochs, writer, tag, device='cuda' if torch.cuda.is_available() else 'cpu',
+          loss_chunk_size=None, precision="fp32", compile_model=False, history=None, should_stop=None,
+          log_every=100, checkpointer=None, resume_from=None, accum_steps=1, eval_set=None, eval_every=None,
+          step_eval_set=None,
+          profile=None, profile_dir=None):
+    # optimizer is built on model's own parameters, so MuAdam groups and infshapes survive torch.compile
+    step_model = torch.compile(model) if compile_model else model
+    # bf16 has fp32 range and needs no loss scaling; fp16 does
+    scaler = torch.amp.GradScaler(torch.device(device).type, enabled=precision == "fp16")
+    metrics = MetricsLogger(writer, tag, flush_every=log_every)
     model.train()
     global_step = 0
+    start_epoch = 0
+    resume = None
+    if resume_from is not None:
+        resume = load_checkpoint(resume_from, model, optimizer, scaler, map_location=device)
+        global_step, start_epoch = resume["global_step"], resume["epoch"]
+        print(f"{tag} - Resumed from {resume_from} at epoch {start_epoch + 1}, step {global_step}")
     epoch_times = []
-    for epoch in range(epochs):
+    num_batches = len(train_loader)
+    reset_peak_memory(device)
+    optimizer.zero_grad()
+    # profile=True (or a dict overriding PROFILE_SCHEDULE) traces optimizer steps into the run's log dir
+    profiler = None
+    ranges = contextlib.nullcontext
+    if profile:
+        profile_dir = profile_dir or getattr(writer, "log_dir", None) or f"runs/{tag}"
+        profiler = make_profiler(profile, profile_dir, device)
+        profiler.start()
+        nvtx = torch.device(device).type == "cuda"
+        ranges = lambda name: profile_range(name, nvtx)
+    for epoch in range(start_epoch, epochs):
+        set_loader_epoch(train_loader, epoch)
         epoch_start_time = time.time()
-        epoch_loss = 0
-
-        for batch_idx, batch in enumerate(train_loader):
-            optimizer.zero_grad()
-            batch = batch.to(device)
-            logits = model(batch)
-            loss = criterion(logits.view(-1, vocab_size), batch.view(-1))
-            loss.backward()
-            optimizer.step()
-
-            writer.add_scalar(f"{tag}/batch_loss", loss.item(), global_step)
-            epoch_loss += loss.item()
+        epoch_tokens = 0
+        skip_batches = 0
+        if resume is not None:
+            # replay the epoch-start RNG so the loader draws the same order, then skip what was trained
+            metrics.restore_epoch_state(resume["epoch_loss_sum"], resume["epoch_loss_steps"], device)
+            skip_batches = resume["batch_idx"]
+            if resume["epoch_rng"] is not None:
+                torch.set_rng_state(resume["epoch_rng"])
+            else:
+                set_rng_state(resume["rng"])
+                resume = None
+        epoch_rng = torch.get_rng_state()
+
+        for batch_idx, batch in enumerate(ranged_batches(train_loader, ranges) if profiler else train_loader):
+            if batch_idx < skip_batches:
+                continue
+            if resume is not None:
+                set_rng_state(resume["rng"])
+                resume = None
+            # accum_steps micro-batches per optimizer step; a short last group is averaged over its own size
+            group_start = batch_idx - batch_idx % accum_steps
+            group_size = min(accum_steps, num_batches - group_start)
+            with ranges("data_load"):
+                batch = batch.to(device).long()
+            # DDP all-reduces gradients only on the last micro-batch of a group
+            is_last_micro_batch = batch_idx + 1 == group_start + group_size
+            sync_context = model.no_sync if hasattr(model, "no_sync") and not is_last_micro_batch else contextlib.nullcontext
+            with sync_context():
+                with ranges("forward"), autocast_context(device, precision):
+                    loss = compute_loss(step_model, batch, criterion, vocab_size, loss_chunk_size) / group_size
+                with ranges("backward"):
+                    scaler.scale(loss).backward()
+            step_loss = loss.detach() if batch_idx == group_start else step_loss + loss.detach()
+            epoch_tokens += batch.numel()
+            if not is_last_micro_batch:
+                continue
+            with ranges("optimizer_step"):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+            if profiler is not None:
+                profiler.step()
+
+            metrics.log_step(step_loss, global_step)
             global_step += 1
-
+            # eval_every steps use step_eval_set (e.g. a small fixed subset); the epoch-end loss keeps eval_set
+            step_set = step_eval_set if step_eval_set is not None else eval_set
+            if eval_every and step_set is not None and global_step % eval_every == 0:
+                step_val_loss = all_reduce_mean(
+                    evaluate(step_model, step_set, criterion, vocab_size, device, loss_chunk_size, precision), device)
+                metrics.add_scalar(f"{tag}_eval/step_loss", step_val_loss, global_step)
+            if checkpointer is not None:
+                checkpointer.maybe_save(global_step, model, optimizer, epoch, batch_idx + 1, epoch_rng, scaler, metrics)
+
+        if resume is not None:
+            set_rng_state(resume["rng"])
+            resume = None
+        epoch_loss = all_reduce_mean(metrics.epoch_loss(), device)
         epoch_time = time.time() - epoch_start_time
         epoch_times.append(epoch_time)
-
-        epoch_loss /= len(train_loader)
-        writer.add_scalar(f"{tag}_train/epoch_loss", epoch_loss, epoch)
-        writer.add_scalar(f"{tag}_train/epoch_time", epoch_time, epoch)
-
-        print(f"{tag} - Epoch {epoch + 1}, Loss: {epoch_loss:.4f}, Time: {epoch_time:.2f}s")
-        avg_loss, avg_batch_time = validate(model, val_loader, criterion, vocab_size, device)
-        writer.add_scalar(f"{tag}_val/epoch_loss", epoch_loss, epoch)
-        writer.add_scalar(f"{tag}_val/epoch_time", epoch_time, epoch)
+        tokens_per_sec = all_reduce_sum(epoch_tokens, device) / epoch_time
+        peak_mb = peak_memory_mb(device)
+
+        metrics.add_scalar(f"{tag}_train/epoch_loss", epoch_loss, epoch)
+        metrics.add_scalar(f"{tag}_train/epoch_time", epoch_time, epoch)
+        metrics.add_scalar(f"{tag}_train/tokens_per_sec", tokens_per_sec, epoch)
+        metrics.add_scalar(f"{tag}_train/peak_memory_mb", peak_mb, epoch)
+
+        print(f"{tag} - Epoch {epoch + 1}, Loss: {epoch_loss:.4f}, Time: {epoch_time:.2f}s, "
+              f"{tokens_per_sec:.0f} tok/s, Peak Mem: {peak_mb:.0f}MB")
+        if eval_set is not None:
+            avg_loss = evaluate(step_model, eval_set, criterion, vocab_size, device, loss_chunk_size, precision)
+            print(f"Validation Loss: {avg_loss:.4f}")
+        else:
+            avg_loss, avg_batch_time = validate(step_model, val_loader, criterion, vocab_size, device,
+                                                loss_chunk_size, precision)
+        avg_loss = all_reduce_mean(avg_loss, device)
+        if history is not None:
+            history.append({"epoch": epoch, "train_loss": epoch_loss, "val_loss": avg_loss, "epoch_time": epoch_time,
+                            "tokens_per_sec": tokens_per_sec, "peak_memory_mb": peak_mb})
+        metrics.add_scalar(f"{tag}_val/epoch_loss", avg_loss, epoch)
+        metrics.add_scalar(f"{tag}_val/epoch_time", epoch_time, epoch)
+        if checkpointer is not None:
+            checkpointer.save(global_step, model, optimizer, epoch + 1, 0, None, scaler, metrics)
+        if should_stop is not None and should_stop(epoch, epoch_loss, avg_loss):
+            print(f"{tag} - Stopped early after epoch {epoch + 1}")
+            break
+    if profiler is not None:
+        profiler.stop()
+    if checkpointer is not None:
+        checkpointer.wait()
+    metrics.close()
     total_training_time = sum(epoch_times)
     writer.add_text(f"{tag}/total_training_time", f"{total_training_time:.2f}s")
 
     return epoch_times
 
 
-def validate(model, dataloader, criterion, vocab_size, device='cuda' if torch.cuda.is_available() else 'cpu'):
+def validate(model, dataloader, criterion, vocab_size, device='cuda' if torch.cuda.is_available() else 'cpu',
+             loss_chunk_size=None, precision="fp32"):
+    was_training = model.training
     model.eval()
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
     total_batches = len(dataloader)
-    batch_times = []
+    start_time = time.time()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch_idx, batch in enumerate(dataloader):
-            batch_start_time = time.time()
-            batch = batch.to(device)
-            logits = model(batch)
-            loss = criterion(logits.view(-1, vocab_size), batch.view(-1))
-            total_loss += loss.item()
-            batch_times.append(time.time() - batch_start_time)
-
-    avg_loss = total_loss / total_batches
-    avg_batch_time = sum(batch_times) / total_batches
+            batch = batch.to(device).long()
+            with autocast_context(device, precision):
+                loss = compute_loss(model, batch, criterion, vocab_size, loss_chunk_size)
+            total_loss += loss.float()
+
+    avg_loss = total_loss.item() / total_batches
+    avg_batch_time = (time.time() - start_time) / total_batches
     print(f"Validation Loss: {avg_loss:.4f}, Avg Batch Time: {avg_batch_time:.4f}s")
+    # validate used to leave the model in eval mode, which silently disabled dropout for later epochs
+    model.train(was_training)
 
     return avg_loss, avg_batch_time
 
+
+def evaluate(model, eval_set, criterion, vocab_size, device='cuda' if torch.cuda.is_available() else 'cpu',
+             loss_chunk_size=None, precision="fp32"):
+    # row-weighted mean over the pre-built batches; one host sync at the end
+    was_training = model.training
+    model.eval()
+    total_loss = torch.zeros((), device=device)
+    with torch.inference_mode():
+        for batch in eval_set:
+            with autocast_context(device, precision):
+                loss = compute_loss(model, batch, criterion, vocab_size, loss_chunk_size)
+            total_loss += loss.float() * batch.size(0)
+    model.train(was_training)
+    return total_loss.item() / max(eval_set.num_rows, 1)
+
+def bench_logging_overhead(steps=200, batch_size=32, hidden_size=64, log_every=100,
+                           device='cuda' if torch.cuda.is_available() else 'cpu'):
+    import tempfile
+    torch.manual_seed(0)
+    model = GPT2Model(vocab_size, seq_len, hidden_size, 4, 4, hidden_size).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss()
+    batch = torch.randint(0, vocab_size, (batch_size, seq_len), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        loss = compute_loss(model, batch, criterion, vocab_size)
+        loss.backward()
+        optimizer.step()
+        return loss
+
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir:
+        writer = SummaryWriter(log_dir)
+        for mode in ("off", "per_step_item", "metrics_logger"):
+            step()
+            metrics = MetricsLogger(writer, mode, flush_every=log_every) if mode == "metrics_logger" else None
+            synchronize(device)
+            start = time.perf_counter()
+            for global_step in range(steps):
+                loss = step()
+                if mode == "per_step_item":
+                    writer.add_scalar(f"{mode}/batch_loss", loss.item(), global_step)
+                elif metrics is not None:
+                    metrics.log_step(loss, global_step)
+            if metrics is not None:
+                metrics.epoch_loss()
+            synchronize(device)
+            results[mode] = (time.perf_counter() - start) / steps * 1000
+            if metrics is not None:
+                metrics.close()
+        writer.close()
+    for mode, step_ms in results.items():
+        print(f"Logging {mode}: {step_ms:.3f} ms/step ({step_ms - results['off']:+.3f} ms vs off)")
+    return results
+
+# bench_logging_overhead()
+
+
+def bench_memory_configs(hidden_size=2560, ff_hidden_size=8192, effective_batch_size=32, micro_batch_sizes=(32, 8),
+                         grad_checkpoints=(False, True), num_layers=4, num_heads=4, steps=3,
+                         device='cuda' if torch.cuda.is_available() else 'cpu'):
+    # peak RSS on CPU never goes down, so configs run from the expected smallest footprint up
+    configs = sorted(itertools.product(micro_batch_sizes, grad_checkpoints), key=lambda c: (c[0], not c[1]))
+    criterion = nn.CrossEntropyLoss()
+    results = []
+    for micro_batch_size, grad_checkpoint in configs:
+        torch.manual_seed(0)
+        accum_steps = accumulation_steps(effective_batch_size, micro_batch_size)
+        model = GPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_layers, ff_hidden_size,
+                          grad_checkpoint=grad_checkpoint).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        batches = torch.randint(0, vocab_size, (accum_steps, micro_batch_size, seq_len), device=device)
+        _, saved_mb = saved_activation_mb(lambda: compute_loss(model, batches[0], criterion, vocab_size))
+        reset_peak_memory(device)
+        start = time.perf_counter()
+        for _ in range(steps):
+            for batch in batches:
+                (compute_loss(model, batch, criterion, vocab_size) / accum_steps).backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        synchronize(device)
+        elapsed = time.perf_counter() - start
+        results.append({"micro_batch_size": micro_batch_size, "accum_steps": accum_steps,
+                        "grad_checkpoint": grad_checkpoint, "ms_per_step": elapsed / steps * 1000,
+                        "tokens_per_sec": steps * effective_batch_size * seq_len / elapsed,
+                        "saved_activation_mb": saved_mb, "peak_memory_mb": peak_memory_mb(device)})
+        print(results[-1])
+        del model, optimizer, batches
+    return results
+
+# bench_memory_configs()
+
 # vocab_size=11442#max_token_idx-1
 
 hidden_size = 64
@@ -245,7 +1422,7 @@ baseline_model = GPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_laye
 optimizer = torch.optim.Adam(baseline_model.parameters(), lr=1e-4)
 criterion = nn.CrossEntropyLoss()
 writer_baseline = SummaryWriter("runs/baseline")
-train(baseline_model, train_loader, val_loader, optimizer, criterion, 10, writer_baseline, "Baseline", device)
+train(baseline_model, train_loader, val_loader, optimizer, criterion, 10, writer_baseline, "Baseline", device, eval_set=eval_set)
 
 hidden_size_target = 1024
 ff_hidden_size_target = 512
@@ -262,36 +1439,119 @@ target_model = GPT2Model(
 
 optimizer_target = torch.optim.Adam(target_model.parameters(), lr=1e-4)
 writer_target = SummaryWriter("runs/target")
-train(target_model, train_loader, val_loader, optimizer, criterion, 10, writer_baseline, "Target", device)
+train(target_model, train_loader, val_loader, optimizer, criterion, 10, writer_baseline, "Target", device, eval_set=eval_set)
 
 
 
 """# trying to optimize using mup"""
 
-from mup import MuReadout
-from mup import set_base_shapes, MuAdam
+from mup import MuReadout, MuSharedReadout
+from mup import set_base_shapes, make_base_shapes, MuAdam
+
+
+class TiedMuReadout(MuSharedReadout):
+    # the shared weight is the token embedding, whose init μP keeps width-independent, so the
+    # SP-to-μP rescale set_base_shapes applies to readouts must not touch it
+    def _rescale_parameters(self):
+        self._has_rescaled_params = True
+
+
+class MuAdaptiveLogSoftmaxWithLoss(nn.AdaptiveLogSoftmaxWithLoss):
+    # μP readout for adaptive softmax: every width-to-vocab projection (the head and the last layer of
+    # each tail cluster) is a zero-initialised MuReadout, so each applies output_mult / width_mult once
+    # and set_base_shapes accepts them; the width-to-width tail projections stay plain hidden Linears
+    def __init__(self, *args, output_mult=1.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.head = MuReadout(self.head.in_features, self.head.out_features, bias=self.head.bias is not None,
+                              readout_zero_init=True, output_mult=output_mult)
+        for projection in self.tail:
+            projection[-1] = MuReadout(projection[-1].in_features, projection[-1].out_features, bias=False,
+                                       readout_zero_init=True, output_mult=output_mult)
+
 
 class MuGPT2Model(nn.Module):
-    def __init__(self, vocab_size, max_seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout=0.1):
+    def __init__(self, vocab_size, max_seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout=0.1,
+                 attn_impl="mha", grad_checkpoint=False, tie_embeddings=False, head_type="linear",
+                 cutoffs=ADAPTIVE_CUTOFFS, output_mult=1.0):
         super(MuGPT2Model, self).__init__()
+        self.grad_checkpoint = grad_checkpoint
         self.token_emb = nn.Embedding(vocab_size, hidden_size)
         self.pos_emb = nn.Embedding(max_seq_len, hidden_size)
+        # the sdpa path uses μP's 1/d attention scaling; the base model must use the same attn_impl
         self.blocks = nn.ModuleList([
-            GPT2Block(hidden_size, num_heads, ff_hidden_size, dropout) for _ in range(num_layers)
+            GPT2Block(hidden_size, num_heads, ff_hidden_size, dropout, attn_impl, mup_attn=True)
+            for _ in range(num_layers)
         ])
         self.ln_f = nn.LayerNorm(hidden_size)
-        self.head = MuReadout(hidden_size, vocab_size, readout_zero_init=True)
+        assert not (tie_embeddings and head_type == "adaptive"), "Adaptive softmax head cannot be tied!"
+        # output_mult is the readout's width-independent logit multiplier (MuReadout's output_mult), tunable
+        # on the base model; a tied head starts at logit std ~ output_mult * TIED_EMB_STD * sqrt(base width)
+        if head_type == "adaptive":
+            self.head = MuAdaptiveLogSoftmaxWithLoss(hidden_size, vocab_size, adaptive_cutoffs(vocab_size, cutoffs),
+                                                     output_mult=output_mult)
+        elif tie_embeddings:
+            nn.init.normal_(self.token_emb.weight, std=TIED_EMB_STD)
+            # no bias: MuSharedReadout sizes it from the embedding's hidden dim, not the vocab
+            self.head = TiedMuReadout(self.token_emb.weight, bias=False, output_mult=output_mult)
+        else:
+            self.head = MuReadout(hidden_size, vocab_size, readout_zero_init=True, output_mult=output_mult)
 
-    def forward(self, x):
+    def forward(self, x, targets=None, loss_chunk_size=None):
         seq_len = x.size(1)
         positions = torch.arange(0, seq_len, device=x.device).unsqueeze(0)
         x = self.token_emb(x) + self.pos_emb(positions)
-        for block in self.blocks:
-            x = block(x)
+        x = run_blocks(self.blocks, x, self.grad_checkpoint and self.training)
         x = self.ln_f(x)
-        logits = self.head(x)
+        if targets is not None:
+            return head_loss(self.head, x, targets, loss_chunk_size)
+        logits = head_logits(self.head, x)
         return logits
 
+
+def save_mup_base_shapes(savefile, base_hidden_size, base_ff_hidden_size, **model_kwargs):
+    # a base and a 2x delta model mark exactly the width dimensions as infinite; only their shapes are
+    # read, so they live on the meta device and cost no memory or init time
+    with torch.device("meta"):
+        base_model = MuGPT2Model(hidden_size=base_hidden_size, ff_hidden_size=base_ff_hidden_size, **model_kwargs)
+        delta_model = MuGPT2Model(hidden_size=2 * base_hidden_size, ff_hidden_size=2 * base_ff_hidden_size,
+                                  **model_kwargs)
+    os.makedirs(os.path.dirname(savefile) or ".", exist_ok=True)
+    make_base_shapes(base_model, delta_model, savefile)
+    return savefile
+
+
+def build_mup_model(base_shapes, device='cuda' if torch.cuda.is_available() else 'cpu', **model_kwargs):
+    # parameters are allocated and initialised on device once, no CPU copy; set_base_shapes then only
+    # attaches infshapes and rescales the readout in place. base_shapes: a .bsh path or a base model
+    with torch.device(device):
+        model = MuGPT2Model(**model_kwargs)
+    set_base_shapes(model, base_shapes)
+    return model
+
+
+def check_mup_heads(head_types=("linear", "tied", "adaptive"), vocab_size=3000, seq_len=16, base_hidden_size=64,
+                    hidden_size=256, batch_size=4, device="cpu"):
+    # every readout variant must pass set_base_shapes via build_mup_model and take a finite MuAdam step
+    model_kwargs = dict(vocab_size=vocab_size, max_seq_len=seq_len, num_heads=4, num_layers=2, dropout=0.0,
+                        attn_impl="sdpa")
+    batch = torch.randint(0, vocab_size, (batch_size, seq_len), device=device)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for head_type in head_types:
+            head_kwargs = dict(model_kwargs, tie_embeddings=head_type == "tied",
+                               head_type="adaptive" if head_type == "adaptive" else "linear")
+            base_shapes_path = save_mup_base_shapes(os.path.join(tmp_dir, f"{head_type}.bsh"), base_hidden_size,
+                                                    base_hidden_size, **head_kwargs)
+            model = build_mup_model(base_shapes_path, device, hidden_size=hidden_size, ff_hidden_size=hidden_size,
+                                    **head_kwargs)
+            optimizer = MuAdam(model.parameters(), lr=1e-3)
+            loss = compute_loss(model, batch, nn.CrossEntropyLoss(), vocab_size)
+            loss.backward()
+            optimizer.step()
+            assert torch.isfinite(loss), f"{head_type} head: non-finite loss {loss.item()}"
+            print(f"μP {head_type} head: initial loss {loss.item():.3f}")
+
+check_mup_heads()
+
 target_model_for_mup = MuGPT2Model(
     vocab_size,
     seq_len,
@@ -305,7 +1565,8 @@ target_model_for_mup = MuGPT2Model(
 set_base_shapes(target_model_for_mup, baseline_model)
 optimizer_mup = MuAdam(target_model_for_mup.parameters(), lr=1e-4)
 writer_mup = SummaryWriter("runs/mup")
-train(target_model_for_mup, train_loader, val_loader, optimizer_mup, criterion, 10, writer_mup, "μP Target")
+train(target_model_for_mup, train_loader, val_loader, optimizer_mup, criterion, 10, writer_mup, "μP Target",
+      eval_set=eval_set)
 
 
 
@@ -315,6 +1576,26 @@ train(target_model_for_mup, train_loader, val_loader, optimizer_mup, criterion,
 
 # !rm -rf runs
 
+def run_checkpoint_kwargs(full_name, checkpoint_every=None, resume=False):
+    if not checkpoint_every:
+        return {}
+    ckpt_dir = f"runs/{full_name}/checkpoints"
+    checkpointer = AsyncCheckpointer(ckpt_dir, every_n_steps=checkpoint_every)
+    return {"checkpointer": checkpointer, "resume_from": latest_checkpoint(ckpt_dir) if resume else None}
+
+
+def micro_batch_loader(train_loader, effective_batch_size=32, micro_batch_size=None,
+                       device='cuda' if torch.cuda.is_available() else 'cpu'):
+    # the optimizer step always sees effective_batch_size rows; a smaller micro_batch_size only changes
+    # how many of them are in memory at once. Returns the loader to use and its accum_steps
+    micro_batch_size = micro_batch_size or effective_batch_size
+    accum_steps = accumulation_steps(effective_batch_size, micro_batch_size)
+    if micro_batch_size != train_loader.batch_size:
+        train_loader = SequenceBatchLoader(train_loader.sequences, micro_batch_size, shuffle=True, device=device,
+                                           pin_memory=True, prefetch=2)
+    return train_loader, accum_steps
+
+
 def run_train_base(name='baseline',
                   epochs=10,
                   hidden_size = 64,
@@ -326,13 +1607,24 @@ def run_train_base(name='baseline',
                   lr=1e-4,
                   train_loader=train_loader,
                   val_loader=val_loader,
-                  seq_len=60):
+                  seq_len=60,
+                  attn_impl="mha",
+                  checkpoint_every=None,
+                  resume=False,
+                  effective_batch_size=32,
+                  micro_batch_size=None,
+                  eval_set=eval_set,
+                  **train_kwargs):
     full_name = f"{name}.ep{epochs}.hs{hidden_size}.ffhs{ff_hidden_size}.lr{lr}.seqlen{seq_len}"
-    baseline_model = GPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout).to(device)
+    baseline_model = GPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout,
+                               attn_impl).to(device)
     optimizer = torch.optim.Adam(baseline_model.parameters(), lr=1e-4)
     criterion = nn.CrossEntropyLoss()
     writer_baseline = SummaryWriter(f"runs/{full_name}")
-    train(baseline_model, train_loader, val_loader, optimizer, criterion, epochs, writer_baseline, full_name, device)
+    train_loader, accum_steps = micro_batch_loader(train_loader, effective_batch_size, micro_batch_size, device)
+    train(baseline_model, train_loader, val_loader, optimizer, criterion, epochs, writer_baseline, full_name, device,
+          accum_steps=accum_steps, eval_set=eval_set, **run_checkpoint_kwargs(full_name, checkpoint_every, resume),
+          **train_kwargs)
     return epochs, num_heads, num_layers, dropout, device, lr, baseline_model
 
 
@@ -346,13 +1638,24 @@ def run_train_target(name='target',
                   device = 'cuda' if torch.cuda.is_available() else 'cpu',
                   lr=1e-4,
                   train_loader=train_loader,
-                  val_loader=val_loader):
+                  val_loader=val_loader,
+                  attn_impl="mha",
+                  checkpoint_every=None,
+                  resume=False,
+                  effective_batch_size=32,
+                  micro_batch_size=None,
+                  eval_set=eval_set,
+                  **train_kwargs):
     full_name = f"{name}.ep{epochs}.hs{hidden_size}.ffhs{ff_hidden_size}.lr{lr}.seqlen{seq_len}"
-    baseline_model = GPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout).to(device)
+    baseline_model = GPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout,
+                               attn_impl).to(device)
     optimizer = torch.optim.Adam(baseline_model.parameters(), lr=lr)
     criterion = nn.CrossEntropyLoss()
     writer_baseline = SummaryWriter(f"runs/{full_name}")
-    train(baseline_model, train_loader, val_loader, optimizer, criterion, epochs, writer_baseline, full_name, device)
+    train_loader, accum_steps = micro_batch_loader(train_loader, effective_batch_size, micro_batch_size, device)
+    train(baseline_model, train_loader, val_loader, optimizer, criterion, epochs, writer_baseline, full_name, device,
+          accum_steps=accum_steps, eval_set=eval_set, **run_checkpoint_kwargs(full_name, checkpoint_every, resume),
+          **train_kwargs)
     return target_model
 
 
@@ -367,49 +1670,680 @@ def run_train_mutarget(name='μP Target',
                   lr=1e-4,
                   baseline_model=None,
                   train_loader=train_loader,
-                  val_loader=val_loader):
+                  val_loader=val_loader,
+                  attn_impl="mha",
+                  checkpoint_every=None,
+                  resume=False,
+                  effective_batch_size=32,
+                  micro_batch_size=None,
+                  eval_set=eval_set,
+                  base_hidden_size=64,
+                  base_ff_hidden_size=64,
+                  **train_kwargs):
     full_name = f"{name}.ep{epochs}.hs{hidden_size}.ffhs{ff_hidden_size}.lr{lr}.seqlen{seq_len}"
-    target_model_for_mup = MuGPT2Model(vocab_size, seq_len, hidden_size, num_heads, num_layers, ff_hidden_size, dropout).to(device)
-    set_base_shapes(target_model_for_mup, baseline_model)
+    model_kwargs = dict(vocab_size=vocab_size, max_seq_len=seq_len, num_heads=num_heads, num_layers=num_layers,
+                        dropout=dropout, attn_impl=attn_impl)
+    # baseline_model may also be a saved .bsh file, e.g. runs/<run>/checkpoints/<step>/base_shapes.bsh;
+    # without one the base shapes come from meta-device models of base_hidden_size
+    if baseline_model is None:
+        baseline_model = save_mup_base_shapes(f"runs/{full_name}/base_shapes.bsh", base_hidden_size,
+                                              base_ff_hidden_size, **model_kwargs)
+    target_model_for_mup = build_mup_model(baseline_model, device, hidden_size=hidden_size,
+                                           ff_hidden_size=ff_hidden_size, **model_kwargs)
     optimizer = MuAdam(target_model_for_mup.parameters(), lr=lr)
     criterion = nn.CrossEntropyLoss()
     writer_baseline = SummaryWriter(f"runs/{full_name}")
-    train(target_model_for_mup, train_loader, val_loader, optimizer, criterion, epochs, writer_baseline, full_name, device)
+    train_loader, accum_steps = micro_batch_loader(train_loader, effective_batch_size, micro_batch_size, device)
+    train(target_model_for_mup, train_loader, val_loader, optimizer, criterion, epochs, writer_baseline, full_name, device,
+          accum_steps=accum_steps, eval_set=eval_set, **run_checkpoint_kwargs(full_name, checkpoint_every, resume),
+          **train_kwargs)
     return target_model_for_mup
 
-# for i in range(1, 5):
-#     hidden_size_target = int(256*(2**i))
-#     ff_hidden_size_target = int(256*(2**i))
-#     epochs, num_heads, num_layers, dropout, device, lr, baseline_model = run_train_base(name='baseline',
-#                       epochs=10,
-#                       hidden_size = 64,
-#                       ff_hidden_size = 64,
-#                       num_heads = 4,
-#                       num_layers = 4,
-#                       dropout = 0.1,
-#                       device = 'cuda' if torch.cuda.is_available() else 'cpu',
-#                       lr=1e-4)
-
-#     target_model = run_train_target(name='target',
-#                       epochs=epochs,
-#                       hidden_size = hidden_size_target,
-#                       ff_hidden_size = ff_hidden_size_target,
-#                       num_heads = num_heads,
-#                       num_layers = num_layers,
-#                       dropout = dropout,
-#                       device = device,
-#                       lr=lr)
-
-#     target_model_for_mup = run_train_mutarget(name='μP Target',
-#                       epochs=epochs,
-#                       hidden_size = hidden_size_target,
-#                       ff_hidden_size = ff_hidden_size_target,
-#                       num_heads = num_heads,
-#                       num_layers = num_layers,
-#                       dropout = dropout,
-#                       device = device,
-#                       lr=lr,
-#                       baseline_model=baseline_model)
+# Width sweep: every (width, lr, parametrization) trial runs concurrently. Workers memory-map the
+# same token store and μP trials load one base shapes file written before the pool starts.
+import pandas as pd
+
+
+def sweep_trial(spec):
+    start = time.time()
+    row = {key: spec[key] for key in ("parametrization", "hidden_size", "ff_hidden_size", "lr", "device")}
+    try:
+        torch.set_num_threads(spec["num_threads"])
+        # forked CPU trials own their RNGs; threaded GPU trials share the process-global ones, so there the
+        # seed only fixes the batch order (the loader's own generator), not weight init or dropout
+        torch.manual_seed(spec["seed"])
+        device = spec["device"]
+        train_store = TokenStoreDataset(spec["store_path"], "train")
+        val_store = TokenStoreDataset(spec["store_path"], "valid")
+        train_loader = SequenceBatchLoader(train_store, spec["batch_size"], shuffle=True, device=device,
+                                           pin_memory=True, prefetch=2,
+                                           generator=torch.Generator().manual_seed(spec["seed"]))
+        # the epoch-end loss is always the full valid split; eval_batches only sizes the eval_every subset
+        eval_set = EvalSet(val_store, spec["eval_batch_size"], device=device)
+        step_eval_set = None
+        if spec["eval_batches"] is not None:
+            step_eval_set = EvalSet(val_store, spec["eval_batch_size"], spec["eval_batches"], device=device)
+
+        model_kwargs = dict(spec["model_kwargs"], hidden_size=spec["hidden_size"],
+                            ff_hidden_size=spec["ff_hidden_size"])
+        if spec["parametrization"] == "mup":
+            model = build_mup_model(spec["base_shapes_path"], device, **model_kwargs)
+            optimizer = MuAdam(model.parameters(), lr=spec["lr"])
+        else:
+            model = GPT2Model(**model_kwargs).to(device)
+            optimizer = torch.optim.Adam(model.parameters(), lr=spec["lr"])
+
+        full_name = (f"{spec['name']}.{spec['parametrization']}.ep{spec['epochs']}.hs{spec['hidden_size']}"
+                     f".ffhs{spec['ff_hidden_size']}.lr{spec['lr']}.seqlen{model_kwargs['max_seq_len']}")
+        writer = SummaryWriter(f"runs/{full_name}")
+        history = []
+        tuner = spec["tuner"]
+        should_stop = None
+        if tuner is not None:
+            def should_stop(epoch, train_loss, val_loss):
+                return tuner.report(full_name, epoch + 1, val_loss)
+        train(model, train_loader, None, optimizer, nn.CrossEntropyLoss(), spec["epochs"], writer, full_name,
+              device, history=history, should_stop=should_stop, eval_set=eval_set, step_eval_set=step_eval_set,
+              accum_steps=spec["accum_steps"], **spec["train_kwargs"])
+        writer.close()
+        status = tuner.stopped.get(full_name, "ok") if tuner is not None else "ok"
+        row.update(run=full_name, status=status, epochs_run=len(history),
+                   final_train_loss=history[-1]["train_loss"], final_val_loss=history[-1]["val_loss"],
+                   best_val_loss=min(h["val_loss"] for h in history),
+                   tokens_per_sec=sum(h["tokens_per_sec"] for h in history) / len(history),
+                   peak_memory_mb=max(h["peak_memory_mb"] for h in history))
+    except Exception as e:
+        row.update(status=f"failed: {e!r}")
+    row["wall_time"] = time.time() - start
+    return row
+
+
+def run_width_sweep(widths, lrs, parametrizations=("sp", "mup"), epochs=10, name="sweep",
+                    store_path=token_store_path, base_hidden_size=64, base_ff_hidden_size=64, ff_multiplier=1,
+                    num_heads=4, num_layers=4, dropout=0.1, attn_impl="mha", effective_batch_size=32,
+                    micro_batch_size=None, max_workers=None,
+                    out_dir="runs/sweep", seed=0, tuner=None, eval_batch_size=256, eval_batches=None,
+                    tie_embeddings=False, head_type="linear", **train_kwargs):
+    os.makedirs(out_dir, exist_ok=True)
+    header = read_token_store_header(store_path)
+    model_kwargs = dict(vocab_size=header["vocab_size"], max_seq_len=header["seq_len"], num_heads=num_heads,
+                        num_layers=num_layers, dropout=dropout, attn_impl=attn_impl,
+                        tie_embeddings=tie_embeddings, head_type=head_type)
+
+    # base shapes are computed once here instead of training a baseline model per width
+    base_shapes_path = save_mup_base_shapes(os.path.join(out_dir, "base_shapes.bsh"), base_hidden_size,
+                                            base_ff_hidden_size, **model_kwargs)
+
+    specs = [{"name": name, "parametrization": parametrization, "hidden_size": width,
+              "ff_hidden_size": int(width * ff_multiplier), "lr": lr, "epochs": epochs, "seed": seed,
+              "batch_size": micro_batch_size or effective_batch_size,
+              "accum_steps": accumulation_steps(effective_batch_size, micro_batch_size or effective_batch_size),
+              "store_path": store_path, "base_shapes_path": base_shapes_path,
+              "eval_batch_size": eval_batch_size, "eval_batches": eval_batches,
+              "model_kwargs": model_kwargs, "train_kwargs": train_kwargs, "device": "cpu", "tuner": tuner}
+             for parametrization in parametrizations for width in widths for lr in lrs]
+
+    if torch.cuda.is_available():
+        # CUDA is already initialised in this process, so trials share it from threads, one per device
+        free_devices = queue.Queue()
+        for i in range(torch.cuda.device_count()):
+            free_devices.put(f"cuda:{i}")
+        max_workers = max_workers or torch.cuda.device_count()
+
+        def run_trial(spec):
+            device = free_devices.get()
+            try:
+                # the current device is per thread; without this every thread's default stream is cuda:0's
+                torch.cuda.set_device(device)
+                return sweep_trial(dict(spec, device=device))
+            finally:
+                free_devices.put(device)
+
+        executor = ThreadPoolExecutor(max_workers)
+    else:
+        max_workers = max_workers or min(len(specs), os.cpu_count() or 1)
+        run_trial = sweep_trial
+        executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("fork"))
+    num_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    for spec in specs:
+        spec["num_threads"] = num_threads
+
+    rows = []
+    with executor:
+        futures = [executor.submit(run_trial, spec) for spec in specs]
+        for future in as_completed(futures):
+            rows.append(future.result())
+            print(f"Sweep {len(rows)}/{len(specs)}: {rows[-1]}")
+
+    results = pd.DataFrame(rows).sort_values(["parametrization", "hidden_size", "lr"], ignore_index=True)
+    results.to_csv(os.path.join(out_dir, "sweep_results.csv"), index=False)
+    return results
+
+class ASHATuner:
+    """Asynchronous successive halving (stopping variant) shared by all sweep workers.
+
+    Rungs sit at min_epochs * eta**k epochs. A trial reaching a rung keeps training only if its
+    validation loss is within the best 1/eta of the losses already recorded there, so the first
+    trials through a rung always continue and later ones must beat them. NaN/inf or losses above
+    max_loss stop a trial at any epoch. State lives in a multiprocessing Manager so forked workers
+    and threads see the same rungs.
+    """
+
+    def __init__(self, manager, max_epochs, min_epochs=1, eta=3, max_loss=None):
+        self.milestones = []
+        milestone = min_epochs
+        while milestone < max_epochs:
+            self.milestones.append(milestone)
+            milestone *= eta
+        self.eta = eta
+        self.max_loss = max_loss
+        self.rungs = manager.dict({milestone: [] for milestone in self.milestones})
+        self.stopped = manager.dict()
+        self.lock = manager.Lock()
+
+    def report(self, trial, epochs_done, val_loss):
+        if not math.isfinite(val_loss) or (self.max_loss is not None and val_loss > self.max_loss):
+            self.stopped[trial] = f"diverged at epoch {epochs_done}"
+            return True
+        if epochs_done not in self.milestones:
+            return False
+        with self.lock:
+            recorded = self.rungs[epochs_done]
+            cutoff = np.percentile(recorded, 100 / self.eta) if recorded else None
+            self.rungs[epochs_done] = recorded + [val_loss]
+        if cutoff is not None and val_loss > cutoff:
+            self.stopped[trial] = f"stopped at rung {epochs_done}"
+            return True
+        return False
+
+
+def run_asha_search(widths, lrs, parametrizations=("mup",), max_epochs=10, min_epochs=1, eta=3,
+                    divergence_factor=1.5, store_path=token_store_path, **sweep_kwargs):
+    # losses above divergence_factor x the uniform-prediction loss count as diverged
+    max_loss = divergence_factor * math.log(read_token_store_header(store_path)["vocab_size"])
+    with multiprocessing.Manager() as manager:
+        tuner = ASHATuner(manager, max_epochs, min_epochs, eta, max_loss)
+        return run_width_sweep(widths, lrs, parametrizations, epochs=max_epochs, store_path=store_path,
+                               tuner=tuner, **sweep_kwargs)
+
+# sweep_results = run_width_sweep(widths=[256 * (2 ** i) for i in range(1, 5)], lrs=[3e-5, 1e-4, 3e-4, 1e-3],
+#                                 epochs=10, base_hidden_size=64, base_ff_hidden_size=64)
+
+# proxy_results = run_asha_search(widths=[64, 128, 256], lrs=[1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2],
+#                                 max_epochs=9, min_epochs=1, eta=3)
+
+# where the step time goes at each width: trace + op table land in runs/{full_name}/profile.step*
+# profile_results = run_width_sweep(widths=[256, 1024, 2560], lrs=[1e-4], epochs=1, profile={"active": 5})
+
+# a smaller head at the widest widths: tied token_emb/readout, or an adaptive softmax over frequency buckets
+# tied_results = run_width_sweep(widths=[1024, 2560], lrs=[1e-4], name="tied", tie_embeddings=True)
+# adaptive_results = run_width_sweep(widths=[1024, 2560], lrs=[1e-4], name="adaptive", head_type="adaptive")
+
+# Lockstep width sweep: every μP width trains in one process on the same batches, so each batch is read,
+# collated and copied to the device once per step instead of once per width.
+
+def train_lockstep(models, optimizers, tags, writers, train_loader, eval_set, criterion, epochs,
+                   device='cuda' if torch.cuda.is_available() else 'cpu', loss_chunk_size=None, precision="fp32",
+                   log_every=100, histories=None):
+    scalers = [torch.amp.GradScaler(torch.device(device).type, enabled=precision == "fp16") for _ in models]
+    metrics = [MetricsLogger(writer, tag, flush_every=log_every) for writer, tag in zip(writers, tags)]
+    histories = histories if histories is not None else [[] for _ in models]
+    for model, optimizer in zip(models, optimizers):
+        model.train()
+        optimizer.zero_grad()
+    global_step = 0
+    for epoch in range(epochs):
+        set_loader_epoch(train_loader, epoch)
+        epoch_start_time = time.time()
+        epoch_tokens = 0
+        for batch in train_loader:
+            batch = batch.to(device).long()
+            epoch_tokens += batch.numel()
+            for model, optimizer, scaler, logger in zip(models, optimizers, scalers, metrics):
+                with autocast_context(device, precision):
+                    loss = compute_loss(model, batch, criterion, vocab_size, loss_chunk_size)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                logger.log_step(loss, global_step)
+            global_step += 1
+
+        # wall time and throughput are shared: every model saw every token of the epoch
+        epoch_time = time.time() - epoch_start_time
+        tokens_per_sec = epoch_tokens / epoch_time
+        for model, tag, logger, history in zip(models, tags, metrics, histories):
+            epoch_loss = logger.epoch_loss()
+            val_loss = evaluate(model, eval_set, criterion, vocab_size, device, loss_chunk_size, precision)
+            logger.add_scalar(f"{tag}_train/epoch_loss", epoch_loss, epoch)
+            logger.add_scalar(f"{tag}_train/epoch_time", epoch_time, epoch)
+            logger.add_scalar(f"{tag}_train/tokens_per_sec", tokens_per_sec, epoch)
+            logger.add_scalar(f"{tag}_val/epoch_loss", val_loss, epoch)
+            history.append({"epoch": epoch, "train_loss": epoch_loss, "val_loss": val_loss,
+                            "epoch_time": epoch_time, "tokens_per_sec": tokens_per_sec})
+            print(f"{tag} - Epoch {epoch + 1}, Loss: {epoch_loss:.4f}, Val Loss: {val_loss:.4f}")
+        print(f"Lockstep epoch {epoch + 1}: {epoch_time:.2f}s, {tokens_per_sec:.0f} tok/s x {len(models)} models, "
+              f"Peak Mem: {peak_memory_mb(device):.0f}MB")
+    for logger in metrics:
+        logger.close()
+    return histories
+
+
+def run_lockstep_sweep(widths, lrs, epochs=10, name="lockstep", store_path=token_store_path, base_hidden_size=64,
+                       base_ff_hidden_size=64, ff_multiplier=1, num_heads=4, num_layers=4, dropout=0.1,
+                       attn_impl="mha", batch_size=32, seed=0, eval_batch_size=256, eval_batches=None,
+                       device='cuda' if torch.cuda.is_available() else 'cpu', out_dir="runs/lockstep",
+                       **train_kwargs):
+    # all widths x lrs live on the device together; split the widths over several calls if they do not fit
+    os.makedirs(out_dir, exist_ok=True)
+    header = read_token_store_header(store_path)
+    model_kwargs = dict(vocab_size=header["vocab_size"], max_seq_len=header["seq_len"], num_heads=num_heads,
+                        num_layers=num_layers, dropout=dropout, attn_impl=attn_impl)
+    base_shapes_path = save_mup_base_shapes(os.path.join(out_dir, "base_shapes.bsh"), base_hidden_size,
+                                            base_ff_hidden_size, **model_kwargs)
+
+    train_loader = SequenceBatchLoader(TokenStoreDataset(store_path, "train"), batch_size, shuffle=True,
+                                       device=device, pin_memory=True, prefetch=2,
+                                       generator=torch.Generator().manual_seed(seed))
+    eval_set = EvalSet(TokenStoreDataset(store_path, "valid"), eval_batch_size, eval_batches, device=device)
+
+    runs, models, optimizers, tags, writers = [], [], [], [], []
+    for width in widths:
+        for lr in lrs:
+            # the same seed per model, so a width differs from the separate-process sweep only in batch order
+            torch.manual_seed(seed)
+            ff_hidden_size = int(width * ff_multiplier)
+            model = build_mup_model(base_shapes_path, device, hidden_size=width, ff_hidden_size=ff_hidden_size,
+                                    **model_kwargs)
+            full_name = (f"{name}.mup.ep{epochs}.hs{width}.ffhs{ff_hidden_size}.lr{lr}"
+                         f".seqlen{model_kwargs['max_seq_len']}")
+            runs.append({"parametrization": "mup", "hidden_size": width, "ff_hidden_size": ff_hidden_size,
+                         "lr": lr, "run": full_name})
+            models.append(model)
+            optimizers.append(MuAdam(model.parameters(), lr=lr))
+            tags.append(full_name)
+            writers.append(SummaryWriter(f"runs/{full_name}"))
+
+    histories = train_lockstep(models, optimizers, tags, writers, train_loader, eval_set, nn.CrossEntropyLoss(),
+                               epochs, device, **train_kwargs)
+    for writer in writers:
+        writer.close()
+
+    rows = [dict(run, final_train_loss=history[-1]["train_loss"], final_val_loss=history[-1]["val_loss"],
+                 best_val_loss=min(h["val_loss"] for h in history))
+            for run, history in zip(runs, histories)]
+    results = pd.DataFrame(rows).sort_values(["hidden_size", "lr"], ignore_index=True)
+    results.to_csv(os.path.join(out_dir, "lockstep_results.csv"), index=False)
+    return results
+
+# lockstep_results = run_lockstep_sweep(widths=[64, 128, 256, 512], lrs=[1e-4, 3e-4, 1e-3], epochs=10)
+
+# Coordinate check: activation size per layer vs width over the first training steps. Under μP the
+# curves stay flat in width at every step; under standard parametrization they blow up with width.
+COORD_CHECK_MODULES = ("attn", "ff", "ln1", "ln2", "ln_f", "head")
+
+
+class CoordCheckHooks:
+    """Forward hooks recording per-module activation L1 (mean |x|) and RMS.
+
+    Both are vector norms reduced on device in fp32, so no activation is copied; the records are
+    stacked and moved to the host once in to_frame().
+    """
+
+    def __init__(self, model, module_names=COORD_CHECK_MODULES):
+        self.step = 0
+        self.records = []
+        self.handles = [module.register_forward_hook(self._hook(name))
+                        for name, module in model.named_modules()
+                        if name.rsplit(".", 1)[-1] in module_names]
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            if isinstance(output, tuple):
+                output = output[0]
+            with torch.no_grad():
+                numel = output.numel()
+                l1 = torch.linalg.vector_norm(output, ord=1, dtype=torch.float32) / numel
+                rms = torch.linalg.vector_norm(output, ord=2, dtype=torch.float32) / numel ** 0.5
+                self.records.append((self.step, name, torch.stack([l1, rms])))
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def to_frame(self, **columns):
+        values = torch.stack([value for _, _, value in self.records]).cpu().tolist()
+        rows = []
+        for (step, name, _), (l1, rms) in zip(self.records, values):
+            rows.append(dict(columns, step=step, module=name, module_type=name.rsplit(".", 1)[-1], l1=l1, rms=rms))
+        return pd.DataFrame(rows)
+
+
+def coord_check(parametrization="mup", widths=(64, 128, 256, 512, 1024, 2048), steps=5, lr=1e-3, seeds=(0,),
+                batch_size=32, base_hidden_size=64, ff_multiplier=1, num_heads=4, num_layers=4, attn_impl="mha",
+                store_path=token_store_path, device='cuda' if torch.cuda.is_available() else 'cpu',
+                out_dir="runs/coord_check"):
+    os.makedirs(out_dir, exist_ok=True)
+    header = read_token_store_header(store_path)
+    model_kwargs = dict(vocab_size=header["vocab_size"], max_seq_len=header["seq_len"], num_heads=num_heads,
+                        num_layers=num_layers, dropout=0.0, attn_impl=attn_impl)
+    if parametrization == "mup":
+        base_shapes_path = save_mup_base_shapes(os.path.join(out_dir, "base_shapes.bsh"), base_hidden_size,
+                                                int(base_hidden_size * ff_multiplier), **model_kwargs)
+
+    # the same fixed batches for every width and seed
+    loader = SequenceBatchLoader(TokenStoreDataset(store_path, "train"), batch_size, shuffle=True, device=device,
+                                 generator=torch.Generator().manual_seed(0))
+    batches = [batch.long() for batch in itertools.islice(iter(loader), steps)]
+
+    frames = []
+    criterion = nn.CrossEntropyLoss()
+    for seed in seeds:
+        for width in widths:
+            torch.manual_seed(seed)
+            kwargs = dict(model_kwargs, hidden_size=width, ff_hidden_size=int(width * ff_multiplier))
+            if parametrization == "mup":
+                model = build_mup_model(base_shapes_path, device, **kwargs)
+                optimizer = MuAdam(model.parameters(), lr=lr)
+            else:
+                model = GPT2Model(**kwargs).to(device)
+                optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+            model.train()
+            hooks = CoordCheckHooks(model)
+            for step, batch in enumerate(batches):
+                hooks.step = step
+                optimizer.zero_grad()
+                loss = compute_loss(model, batch, criterion, header["vocab_size"])
+                loss.backward()
+                optimizer.step()
+            hooks.remove()
+            frames.append(hooks.to_frame(parametrization=parametrization, width=width, seed=seed))
+            del model, optimizer
+    return pd.concat(frames, ignore_index=True)
+
+
+def plot_coord_check(df, stat="l1", savefile=None):
+    import matplotlib.pyplot as plt
+    module_types = [name for name in COORD_CHECK_MODULES if name in set(df["module_type"])]
+    fig, axes = plt.subplots(1, len(module_types), figsize=(3.2 * len(module_types), 3.2), squeeze=False)
+    # averaged over layers of the same type and over seeds
+    mean = df.groupby(["module_type", "step", "width"], as_index=False)[stat].mean()
+    for ax, module_type in zip(axes[0], module_types):
+        for step, group in mean[mean["module_type"] == module_type].groupby("step"):
+            ax.plot(group["width"], group[stat], marker="o", label=f"t={step}")
+        ax.set_xscale("log", base=2)
+        ax.set_yscale("log")
+        ax.set_title(module_type)
+        ax.set_xlabel("width")
+    axes[0][0].set_ylabel(stat)
+    axes[0][-1].legend(fontsize="small")
+    fig.suptitle(", ".join(sorted(set(df["parametrization"]))))
+    fig.tight_layout()
+    if savefile is not None:
+        fig.savefig(savefile)
+    return fig
+
+# for parametrization in ("sp", "mup"):
+#     coord_df = coord_check(parametrization)
+#     plot_coord_check(coord_df, savefile=f"runs/coord_check/{parametrization}.png")
+
+# Data-parallel training: one process per core group (gloo) or per GPU (nccl). μP base shapes are set
+# before the DDP wrap, so every rank holds the same infshapes and MuAdam builds the same
+# per-parameter lr groups; DDP only averages gradients, which keeps μP's update scaling intact.
+import socket
+from torch.nn.parallel import DistributedDataParallel
+
+
+class NullWriter:
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def add_text(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+def ddp_train_rank(rank, world_size, spec):
+    backend = spec["backend"]
+    if backend == "nccl":
+        device = f"cuda:{int(os.environ.get('LOCAL_RANK', rank))}"
+        torch.cuda.set_device(device)
+    else:
+        device = "cpu"
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    if not dist.is_initialized():
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(spec["seed"])
+        train_store = TokenStoreDataset(spec["store_path"], "train")
+        val_store = TokenStoreDataset(spec["store_path"], "valid")
+        train_loader = SequenceBatchLoader(train_store, spec["micro_batch_size"], shuffle=True, device=device,
+                                           pin_memory=True, prefetch=2, num_replicas=world_size, rank=rank,
+                                           seed=spec["seed"])
+        eval_set = EvalSet(val_store, spec["eval_batch_size"], device=device, num_replicas=world_size, rank=rank)
+        step_eval_set = None
+        if spec["eval_batches"] is not None:
+            step_eval_set = EvalSet(val_store, spec["eval_batch_size"], spec["eval_batches"], device=device,
+                                    num_replicas=world_size, rank=rank)
+
+        model_kwargs = spec["model_kwargs"]
+        if spec["parametrization"] == "mup":
+            model = build_mup_model(spec["base_shapes_path"], device, **model_kwargs)
+            optimizer = MuAdam(model.parameters(), lr=spec["lr"])
+        else:
+            model = GPT2Model(**model_kwargs).to(device)
+            optimizer = torch.optim.Adam(model.parameters(), lr=spec["lr"])
+        ddp_model = DistributedDataParallel(model, device_ids=[torch.device(device).index] if backend == "nccl" else None)
+
+        full_name = spec["full_name"]
+        writer = SummaryWriter(f"runs/{full_name}") if rank == 0 else NullWriter()
+        # every rank keeps the checkpointer: saving gathers all ranks' RNG, only rank 0 writes
+        train(ddp_model, train_loader, None, optimizer, nn.CrossEntropyLoss(), spec["epochs"], writer,
+              full_name, device, accum_steps=spec["accum_steps"], eval_set=eval_set, step_eval_set=step_eval_set,
+              **spec["train_kwargs"])
+        writer.close()
+    finally:
+        dist.destroy_process_group()
+
+
+def run_train_ddp(parametrization="mup", name="ddp", epochs=10, hidden_size=1024, ff_hidden_size=1024, lr=1e-4,
+                  num_heads=4, num_layers=4, dropout=0.1, attn_impl="mha", base_hidden_size=64,
+                  base_ff_hidden_size=64, effective_batch_size=32, micro_batch_size=None, world_size=None,
+                  backend=None, store_path=token_store_path, seed=0, checkpoint_every=None, resume=False,
+                  eval_batch_size=256, eval_batches=None, tie_embeddings=False, head_type="linear", **train_kwargs):
+    backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    torchrun = "RANK" in os.environ and "WORLD_SIZE" in os.environ
+    # the global batch stays effective_batch_size whatever the number of ranks, so it must split evenly
+    valid_world_sizes = [n for n in range(1, effective_batch_size + 1) if effective_batch_size % n == 0]
+    if torchrun:
+        world_size = int(os.environ["WORLD_SIZE"])
+    elif world_size is None:
+        available = torch.cuda.device_count() if backend == "nccl" else os.cpu_count() or 1
+        world_size = max(n for n in valid_world_sizes if n <= available)
+    if world_size not in valid_world_sizes:
+        raise ValueError(f"world_size {world_size} does not divide effective_batch_size {effective_batch_size}; "
+                         f"valid world sizes are {valid_world_sizes}")
+    micro_batch_size = micro_batch_size or effective_batch_size // world_size
+    if effective_batch_size % (micro_batch_size * world_size):
+        raise ValueError(f"micro_batch_size {micro_batch_size} x world_size {world_size} does not divide "
+                         f"effective_batch_size {effective_batch_size}")
+    accum_steps = accumulation_steps(effective_batch_size, micro_batch_size * world_size)
+
+    header = read_token_store_header(store_path)
+    model_kwargs = dict(vocab_size=header["vocab_size"], max_seq_len=header["seq_len"], hidden_size=hidden_size,
+                        num_heads=num_heads, num_layers=num_layers, ff_hidden_size=ff_hidden_size,
+                        dropout=dropout, attn_impl=attn_impl, tie_embeddings=tie_embeddings, head_type=head_type)
+    full_name = (f"{name}.{parametrization}.ep{epochs}.hs{hidden_size}.ffhs{ff_hidden_size}.lr{lr}"
+                 f".seqlen{header['seq_len']}.ws{world_size}")
+    os.makedirs(f"runs/{full_name}", exist_ok=True)
+    if torchrun:
+        # under torchrun every rank runs this function; shared files are written by rank 0 only
+        if backend == "nccl":
+            torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+        dist.init_process_group(backend)
+    base_shapes_path = None
+    if parametrization == "mup":
+        base_shapes_path = f"runs/{full_name}/base_shapes.bsh"
+        if not torchrun or dist.get_rank() == 0:
+            base_model_kwargs = {k: v for k, v in model_kwargs.items() if k not in ("hidden_size", "ff_hidden_size")}
+            save_mup_base_shapes(base_shapes_path, base_hidden_size, base_ff_hidden_size, **base_model_kwargs)
+    if torchrun:
+        dist.barrier()
+    spec = {"backend": backend, "parametrization": parametrization, "full_name": full_name, "epochs": epochs,
+            "lr": lr, "seed": seed, "store_path": store_path, "model_kwargs": model_kwargs,
+            "base_shapes_path": base_shapes_path, "micro_batch_size": micro_batch_size,
+            "accum_steps": accum_steps, "eval_batch_size": eval_batch_size, "eval_batches": eval_batches,
+            "train_kwargs": dict(run_checkpoint_kwargs(full_name, checkpoint_every, resume), **train_kwargs)}
+
+    if torchrun:
+        # launched as `torchrun --nproc_per_node=N ...`: this process is one rank
+        ddp_train_rank(dist.get_rank(), world_size, spec)
+        return full_name
+
+    # local launch; fork keeps the notebook's definitions, which spawn could not re-import
+    if backend == "nccl":
+        assert not torch.cuda.is_initialized(), "CUDA is already initialised here, start NCCL runs with torchrun"
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ["MASTER_PORT"] = str(port)
+    torch.multiprocessing.start_processes(ddp_train_rank, args=(world_size, spec), nprocs=world_size,
+                                          start_method="fork")
+    return full_name
+
+# run_train_ddp("mup", hidden_size=1024, ff_hidden_size=1024, lr=1e-4, epochs=10, world_size=4)
+
+# Generation. Prompts are left-padded with <PAD>, so every row's next token sits in the last column;
+# positions count only real tokens. With attn_impl="sdpa" each layer keeps a KVCache and a new token
+# only runs its own position through the model. The "mha" blocks use a sequence-first nn.MultiheadAttention
+# fed [B, T, H], so they attend across the batch rather than the sequence: a batch of prompts would mix
+# with each other. Those models decode each prompt on its own (batch of 1, no padding), recomputing
+# the whole prefix at every step.
+
+
+def generation_attention_mask(key_mask, num_queries):
+    # [B, 1, Q, K] bool, True = attend: causal over real tokens, plus the diagonal so pad rows stay finite
+    num_keys = key_mask.size(1)
+    key_pos = torch.arange(num_keys, device=key_mask.device)
+    query_pos = key_pos[num_keys - num_queries:]
+    causal = key_pos[None, :] <= query_pos[:, None]
+    mask = (causal[None] & key_mask[:, None, :]) | (key_pos[None, :] == query_pos[:, None])[None]
+    return mask[:, None]
+
+
+def forward_next_token_logits(model, ids, positions, attn_mask=None, kv_caches=None):
+    x = model.token_emb(ids) + model.pos_emb(positions)
+    for i, block in enumerate(model.blocks):
+        x = block(x, attn_mask=attn_mask, kv_cache=kv_caches[i] if kv_caches is not None else None)
+    x = model.ln_f(x[:, -1])
+    return head_logits(model.head, x)
+
+
+def sample_next_token(logits, temperature=1.0, top_k=None, greedy=False, pad_id=0, generator=None):
+    logits = logits.float()
+    logits[:, pad_id] = float("-inf")
+    if greedy or temperature == 0:
+        return logits.argmax(dim=-1)
+    logits = logits / temperature
+    if top_k is not None:
+        kth = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    return torch.multinomial(torch.softmax(logits, dim=-1), 1, generator=generator).squeeze(1)
+
+
+@torch.inference_mode()
+def generate(model, tokenizer, prompts, max_new_tokens=20, temperature=1.0, top_k=None, greedy=False,
+             use_cache=True, seed=None, device=None):
+    device = device or next(model.parameters()).device
+    pad_id = tokenizer.word2idx["<PAD>"]
+    prompt_ids = [tokenizer.encode(prompt.split() if isinstance(prompt, str) else prompt) for prompt in prompts]
+    if not prompt_ids or any(len(ids) == 0 for ids in prompt_ids):
+        raise ValueError("generate needs at least one prompt, each with at least one token")
+    sdpa = all(getattr(block, "attn_impl", "mha") == "sdpa" for block in model.blocks)
+    if not sdpa and len(prompts) > 1:
+        generated = []
+        for prompt in prompts:
+            generated += generate(model, tokenizer, [prompt], max_new_tokens, temperature, top_k, greedy,
+                                  use_cache, seed, device)[0]
+        return generated, [tokenizer.decode(row) for row in generated]
+    prompt_len = max(len(ids) for ids in prompt_ids)
+    max_len = prompt_len + max_new_tokens
+    if max_len > model.pos_emb.num_embeddings:
+        raise ValueError(f"prompt + max_new_tokens = {max_len} exceeds max_seq_len {model.pos_emb.num_embeddings}")
+
+    ids = torch.full((len(prompts), max_len), pad_id, dtype=torch.long, device=device)
+    key_mask = torch.zeros((len(prompts), max_len), dtype=torch.bool, device=device)
+    for row, row_ids in enumerate(prompt_ids):
+        ids[row, prompt_len - len(row_ids):prompt_len] = torch.tensor(row_ids, dtype=torch.long)
+        key_mask[row, prompt_len - len(row_ids):prompt_len] = True
+    positions = (key_mask.long().cumsum(dim=1) - 1).clamp(min=0)
+    generator = torch.Generator(device=device).manual_seed(seed) if seed is not None else None
+
+    was_training = model.training
+    model.eval()
+    kv_caches = [KVCache(max_len) for _ in model.blocks] if use_cache and sdpa else None
+    try:
+        for step in range(max_new_tokens):
+            end = prompt_len + step
+            key_mask[:, end] = True
+            positions[:, end] = positions[:, end - 1] + 1 if end > 0 else 0
+            if kv_caches is not None and step > 0:
+                logits = forward_next_token_logits(model, ids[:, end - 1:end], positions[:, end - 1:end],
+                                                   generation_attention_mask(key_mask[:, :end], 1), kv_caches)
+            elif kv_caches is not None:
+                logits = forward_next_token_logits(model, ids[:, :end], positions[:, :end],
+                                                   generation_attention_mask(key_mask[:, :end], end), kv_caches)
+            else:
+                attn_mask = generation_attention_mask(key_mask[:, :end], end) if sdpa else None
+                logits = forward_next_token_logits(model, ids[:, :end], positions[:, :end], attn_mask)
+            ids[:, end] = sample_next_token(logits, temperature, top_k, greedy, pad_id, generator)
+    finally:
+        # generating between training runs must not leave dropout disabled
+        model.train(was_training)
+
+    generated = ids[:, prompt_len:].tolist()
+    return generated, [tokenizer.decode(row) for row in generated]
+
+
+def bench_generation(model, tokenizer, prompts, max_new_tokens=20, repeats=3):
+    device = next(model.parameters()).device
+    results = {}
+    outputs = {}
+    # mha models have no KV cache and already decode prompt by prompt, see generate
+    sdpa = all(getattr(block, "attn_impl", "mha") == "sdpa" for block in model.blocks)
+    for use_cache in (False, True) if sdpa else (False,):
+        generate(model, tokenizer, prompts, max_new_tokens=2, greedy=True, use_cache=use_cache)
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            outputs[use_cache], _ = generate(model, tokenizer, prompts, max_new_tokens, greedy=True,
+                                             use_cache=use_cache)
+        synchronize(device)
+        elapsed = (time.perf_counter() - start) / repeats
+        mode = "kv_cache" if use_cache else "full_recompute"
+        results[mode] = {"tokens_per_sec": len(prompts) * max_new_tokens / elapsed,
+                         "ms_per_token": elapsed / max_new_tokens * 1000}
+        print(f"{mode}: {results[mode]['tokens_per_sec']:.0f} tok/s, {results[mode]['ms_per_token']:.2f} ms/token")
+    if sdpa:
+        results["same_greedy_output"] = outputs[False] == outputs[True]
+    # matching outputs prove nothing if the model just repeats the last prompt token
+    last_prompt_ids = [tokenizer.encode(prompt.split() if isinstance(prompt, str) else prompt)[-1]
+                       for prompt in prompts]
+    results["echoes_prompt"] = all(all(token == last for token in row)
+                                   for row, last in zip(outputs[sdpa], last_prompt_ids))
+    if results["echoes_prompt"]:
+        print("Warning: greedy output only repeats the last prompt token; check the model's training targets.")
+    return results
+
+# sdpa_model = run_train_base(name='baseline.sdpa', epochs=2, attn_impl="sdpa")[-1]
+# generated_ids, generated_words = generate(sdpa_model, tokenizer, ["the little girl", "once upon a time"],
+#                                           max_new_tokens=30, temperature=0.8, top_k=50)
+# bench_generation(sdpa_model, tokenizer, ["the little girl"] * 16, max_new_tokens=40)
 
 hidden_size_target = int(256*(2*5))
 ff_hidden_size_target = int(256*(2**5))
@@ -485,7 +2419,8 @@ torch.cuda.empty_cache()
 
 
 optimizer_mup = writer_mup = SummaryWriter("runs/mup")
-train(target_model_for_mup, train_loader, val_loader, optimizer_mup, criterion, 10, writer_mup, "μP Target")
+train(target_model_for_mup, train_loader, val_loader, optimizer_mup, criterion, 10, writer_mup, "μP Target",
+      eval_set=eval_set)
 
 import os
 import pandas as pd
@@ -535,13 +2470,338 @@ def collect_all_event_logs_to_dataframe(runs_dir):
     combined_df = pd.concat(all_dfs, ignore_index=True)
     return combined_df
 
-runs_dir = "/content/runs"
-combined_df = collect_all_event_logs_to_dataframe(runs_dir)
-combined_df = combined_df.drop(columns='batch_loss').dropna()
-combined_df.loc[:, 'split'] = combined_df.loc[:, 'model'].apply(lambda x: x.split('_')[1])
-combined_df.loc[:, 'model'] = combined_df.loc[:, 'model'].apply(lambda x: x.split('_')[0].lower())
+# Incremental ingestion: tfevents files are parsed record by record in a process pool, and the byte
+# offset reached in every file is kept in <store_dir>/_offsets.json so reruns only read new records.
+# Scalars land in a Parquet store partitioned by run: <store_dir>/run=<run>/<event file>.<offset>.parquet.
+# A part is named after the offset it starts at, so re-ingesting after a crash overwrites it.
+from urllib.parse import quote
+from tensorboard.compat.proto import event_pb2
+
+TFEVENT_HEADER = struct.Struct("<QI")
+
+
+def read_tfevent_records(path, offset=0):
+    """Yields (record bytes, end offset); stops at a record that is not fully written yet."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            header = f.read(TFEVENT_HEADER.size)
+            if len(header) < TFEVENT_HEADER.size:
+                return
+            length, _ = TFEVENT_HEADER.unpack(header)
+            data = f.read(length)
+            footer = f.read(4)
+            if len(data) < length or len(footer) < 4:
+                return
+            yield data, f.tell()
+
+
+def split_metric_tag(tag):
+    prefix, metric = tag.split('/', 1) if '/' in tag else (tag, "unknown_metric")
+    model, _, split = prefix.rpartition('_')
+    if split not in ("train", "val", "eval"):
+        model, split = prefix, "batch"
+    return model, split, metric
+
+
+def _ingest_event_file(job):
+    path, offset, partition_dir = job
+    columns = {"tag": [], "model": [], "split": [], "metric": [], "step": [], "wall_time": [], "value": []}
+    end = offset
+    for data, end in read_tfevent_records(path, offset):
+        event = event_pb2.Event.FromString(data)
+        for value in event.summary.value:
+            if value.HasField("simple_value"):
+                scalar = value.simple_value
+            elif value.HasField("tensor") and value.metadata.plugin_data.plugin_name == "scalars":
+                scalar = (list(value.tensor.float_val) or list(value.tensor.double_val) or [float("nan")])[0]
+            else:
+                continue
+            model, split, metric = split_metric_tag(value.tag)
+            columns["tag"].append(value.tag)
+            columns["model"].append(model)
+            columns["split"].append(split)
+            columns["metric"].append(metric)
+            columns["step"].append(event.step)
+            columns["wall_time"].append(event.wall_time)
+            columns["value"].append(scalar)
+    if columns["tag"]:
+        os.makedirs(partition_dir, exist_ok=True)
+        part_path = os.path.join(partition_dir, f"{os.path.basename(path)}.{offset}.parquet")
+        pd.DataFrame(columns).to_parquet(part_path + ".tmp", index=False)
+        os.replace(part_path + ".tmp", part_path)
+    return path, end, len(columns["tag"])
+
+
+def ingest_event_logs(runs_dir, store_dir, num_workers=None):
+    os.makedirs(store_dir, exist_ok=True)
+    state_path = os.path.join(store_dir, "_offsets.json")
+    offsets = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            offsets = json.load(f)
+
+    jobs = []
+    for root, dirs, files in os.walk(runs_dir):
+        for file in files:
+            if file.startswith("events.out.tfevents"):
+                path = os.path.join(root, file)
+                if os.path.getsize(path) > offsets.get(path, 0):
+                    run = os.path.relpath(root, runs_dir)
+                    jobs.append((path, offsets.get(path, 0), os.path.join(store_dir, f"run={quote(run, safe='')}")))
+
+    total_records = 0
+    num_workers = max(1, min(num_workers or os.cpu_count() or 1, len(jobs)))
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        for path, end, num_records in pool.map(_ingest_event_file, jobs):
+            offsets[path] = end
+            total_records += num_records
+    with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(offsets, f)
+    os.replace(state_path + ".tmp", state_path)
+    print(f"Ingested {total_records} scalars from {len(jobs)} event files into {store_dir}")
+    return total_records
+
+
+def query_metrics(store_dir, runs=None, metrics=None, splits=None, columns=None):
+    filters = []
+    if runs is not None:
+        filters.append(("run", "in", list(runs)))
+    if metrics is not None:
+        filters.append(("metric", "in", list(metrics)))
+    if splits is not None:
+        filters.append(("split", "in", list(splits)))
+    df = pd.read_parquet(store_dir, columns=columns, filters=filters or None)
+    if "run" in df.columns:
+        df["run"] = df["run"].astype(str)
+    return df
+
+
+def loss_vs_width(store_dir, metric="epoch_loss", split="val", step=None):
+    df = query_metrics(store_dir, metrics=[metric], splits=[split])
+    if step is not None:
+        df = df[df["step"] == step]
+    # the last logged value of every run, with width / lr / parametrization parsed from the run name
+    df = df.sort_values("step").groupby("run", as_index=False).last()
+    parsed = df["run"].str.extract(r"^(?P<name>.*?)\.ep\d+\.hs(?P<hidden_size>\d+)\..*?\.lr(?P<lr>[^/]+?)\.seqlen")
+    df = pd.concat([df, parsed], axis=1).dropna(subset=["hidden_size"])
+    df["hidden_size"] = df["hidden_size"].astype(int)
+    df["lr"] = df["lr"].astype(float)
+    return df[["run", "name", "hidden_size", "lr", "step", "value"]].sort_values(["name", "lr", "hidden_size"])
+
+
+def plot_loss_vs_width(df, ylabel="val loss"):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(7, 5))
+    for (name, lr), group in df.groupby(["name", "lr"]):
+        ax.plot(group["hidden_size"], group["value"], marker="o", label=f"{name} lr={lr:g}")
+    ax.set_xscale("log", base=2)
+    ax.set_xlabel("hidden size")
+    ax.set_ylabel(ylabel)
+    ax.legend(fontsize="small")
+    return fig
+
+import platform
+
+BENCH_HIGHER_IS_BETTER = ("tokens_per_sec", "records_per_sec")
+BENCH_LOWER_IS_BETTER = ("seconds", "ms_per_step", "forward_ms", "backward_ms", "optimizer_ms", "peak_rss_mb")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux; worker pools started by a stage are counted through RUSAGE_CHILDREN
+    return max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) / 1024
+
+
+def _bench_case(fn, *args):
+    # a forked child's ru_maxrss starts at the parent's RSS, so report the growth above that baseline:
+    # peak_rss_mb is what the case itself added, independent of what the notebook had loaded before
+    base_rss_mb = peak_rss_mb()
+    result = fn(*args)
+    result.update(peak_rss_mb=peak_rss_mb() - base_rss_mb, base_rss_mb=base_rss_mb)
+    return result
+
+
+def _bench_isolated(fn, *args):
+    # each case runs in a freshly forked process, so a big case cannot hide the peak RSS of a later small one;
+    # a forked child cannot use CUDA once this process has initialised it, so those cases run in place
+    try:
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            return dict(_bench_case(fn, *args), isolated=False)
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("fork")) as pool:
+            return pool.submit(_bench_case, fn, *args).result()
+    except Exception as e:
+        return {"error": repr(e)}
+
+
+def _bench_tokenize(train_path, vocab_size, num_workers):
+    start = time.perf_counter()
+    tokenizer = SimpleBooksTokenizer(vocab_size=vocab_size)
+    num_tokens = sum(len(ids) for ids, _ in tokenizer.fit_encode_file(train_path, num_workers))
+    elapsed = time.perf_counter() - start
+    return {"tokens": num_tokens, "seconds": elapsed, "tokens_per_sec": num_tokens / elapsed}
+
+
+def _bench_dataset_build(data_dir, vocab_size, store_path, seq_len, num_workers):
+    start = time.perf_counter()
+    build_token_store(data_dir, SimpleBooksTokenizer(vocab_size=vocab_size), store_path, seq_len,
+                      num_workers=num_workers)
+    elapsed = time.perf_counter() - start
+    header = read_token_store_header(store_path)
+    tokens = sum(rows for _, rows in header["offsets"].values()) * header["seq_len"]
+    return {"tokens": tokens, "seconds": elapsed, "tokens_per_sec": tokens / elapsed}
+
+
+def _bench_loader(store_path, batch_size, max_batches, device):
+    # pinning initialises CUDA, which a forked child cannot do once the notebook has
+    loader = SequenceBatchLoader(TokenStoreDataset(store_path, "train"), batch_size, shuffle=True, device=device,
+                                 pin_memory=torch.device(device).type == "cuda", prefetch=2)
+    tokens = 0
+    start = time.perf_counter()
+    for batch_idx, batch in enumerate(loader):
+        if batch_idx == max_batches:
+            break
+        tokens += batch.numel()
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+    return {"tokens": tokens, "seconds": elapsed, "tokens_per_sec": tokens / elapsed}
+
+
+def _bench_train_step(parametrization, model_kwargs, base_shapes_path, batch_size, steps, warmup, device):
+    torch.manual_seed(0)
+    if parametrization == "mup":
+        model = build_mup_model(base_shapes_path, device, **model_kwargs)
+        optimizer = MuAdam(model.parameters(), lr=1e-4)
+    else:
+        model = GPT2Model(**model_kwargs).to(device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss()
+    batch = torch.randint(0, model_kwargs["vocab_size"], (batch_size, model_kwargs["max_seq_len"]), device=device)
+
+    timings = {"forward_ms": 0.0, "backward_ms": 0.0, "optimizer_ms": 0.0}
+    for step in range(warmup + steps):
+        start = time.perf_counter()
+        loss = compute_loss(model, batch, criterion, model_kwargs["vocab_size"])
+        synchronize(device)
+        forward_done = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        backward_done = time.perf_counter()
+        optimizer.step()
+        optimizer.zero_grad()
+        synchronize(device)
+        if step >= warmup:
+            timings["forward_ms"] += (forward_done - start) * 1000 / steps
+            timings["backward_ms"] += (backward_done - forward_done) * 1000 / steps
+            timings["optimizer_ms"] += (time.perf_counter() - backward_done) * 1000 / steps
+    ms_per_step = sum(timings.values())
+    return dict(timings, ms_per_step=ms_per_step, tokens_per_sec=batch.numel() / ms_per_step * 1000,
+                params=sum(p.numel() for p in model.parameters()),
+                peak_memory_mb=peak_memory_mb(device) if torch.device(device).type == "cuda" else None)
+
+
+def _bench_ingest(runs_dir, store_dir, num_workers):
+    start = time.perf_counter()
+    records = ingest_event_logs(runs_dir, store_dir, num_workers)
+    elapsed = time.perf_counter() - start
+    return {"records": records, "seconds": elapsed, "records_per_sec": records / elapsed}
+
+
+def write_synthetic_event_logs(runs_dir, num_runs=8, num_steps=2000):
+    for run in range(num_runs):
+        writer = SummaryWriter(os.path.join(runs_dir, f"bench.hs{64 << run % 6}.run{run}"))
+        for step in range(num_steps):
+            writer.add_scalar(f"bench{run}_train/batch_loss", 10.0 / (step + 1), step)
+            if step % 100 == 0:
+                writer.add_scalar(f"bench{run}_val/epoch_loss", 10.0 / (step + 1), step)
+        writer.close()
+
+
+def run_benchmark_suite(data_dir=dataset_dir, out_path="bench/pipeline.json", baseline_path=None, tolerance=0.1,
+                        stages=("tokenize", "dataset_build", "loader", "train_step", "ingest"),
+                        widths=(64, 128, 256, 512, 1024, 2048, 2560), parametrizations=("sp", "mup"),
+                        vocab_size=15000, seq_len=60, ff_multiplier=1, num_heads=4, num_layers=4, batch_size=8,
+                        steps=5, warmup=2, loader_batches=200, num_workers=None, device="cpu"):
+    """Time each pipeline stage in isolation and write {case: metrics} JSON to out_path.
+
+    Cases are keyed by stage (and parametrization/width for train_step) so two JSON files can be diffed
+    with compare_benchmarks; with baseline_path, regressions beyond tolerance are printed and returned.
+    """
+    train_path = os.path.join(data_dir, "simplebooks/simplebooks-2/train.txt")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store_path = os.path.join(tmp_dir, "bench.tok")
+        if "tokenize" in stages:
+            results["tokenize"] = _bench_isolated(_bench_tokenize, train_path, vocab_size, num_workers)
+        if "dataset_build" in stages or "loader" in stages:
+            results["dataset_build"] = _bench_isolated(_bench_dataset_build, data_dir, vocab_size, store_path,
+                                                       seq_len, num_workers)
+        if "loader" in stages:
+            results["loader"] = _bench_isolated(_bench_loader, store_path, batch_size, loader_batches, device)
+        if "train_step" in stages:
+            model_kwargs = dict(vocab_size=vocab_size, max_seq_len=seq_len, num_heads=num_heads,
+                                num_layers=num_layers, dropout=0.0)
+            base_shapes_path = save_mup_base_shapes(os.path.join(tmp_dir, "base_shapes.bsh"), widths[0],
+                                                    int(widths[0] * ff_multiplier), **model_kwargs)
+            for parametrization in parametrizations:
+                for width in widths:
+                    case_kwargs = dict(model_kwargs, hidden_size=width, ff_hidden_size=int(width * ff_multiplier))
+                    case = f"train_step/{parametrization}/hs{width}"
+                    results[case] = _bench_isolated(_bench_train_step, parametrization, case_kwargs,
+                                                    base_shapes_path, batch_size, steps, warmup, device)
+                    print(case, results[case])
+        if "ingest" in stages:
+            runs_dir = os.path.join(tmp_dir, "runs")
+            write_synthetic_event_logs(runs_dir)
+            results["ingest"] = _bench_isolated(_bench_ingest, runs_dir, os.path.join(tmp_dir, "metrics"),
+                                                num_workers)
+
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "torch": torch.__version__,
+                       "python": platform.python_version(), "machine": platform.machine(),
+                       "cpu_count": os.cpu_count(), "num_threads": torch.get_num_threads(), "device": device,
+                       "batch_size": batch_size, "seq_len": seq_len, "vocab_size": vocab_size},
+              "results": results}
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    if baseline_path is not None:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        comparison = compare_benchmarks(report, baseline, tolerance)
+        regressions = comparison[comparison["regression"]]
+        print(regressions.to_string() if len(regressions) else "No regressions against baseline.")
+        return report, comparison
+    return report
+
+
+def compare_benchmarks(current, baseline, tolerance=0.1):
+    # change > 0 is always worse: slower throughput, or more time / memory
+    rows = []
+    for case, base_metrics in baseline["results"].items():
+        metrics = current["results"].get(case)
+        if metrics is None or "error" in metrics or "error" in base_metrics:
+            continue
+        for metric, base_value in base_metrics.items():
+            if metric not in metrics or not base_value:
+                continue
+            if metric in BENCH_HIGHER_IS_BETTER:
+                change = base_value / metrics[metric] - 1 if metrics[metric] else float("inf")
+            elif metric in BENCH_LOWER_IS_BETTER:
+                change = metrics[metric] / base_value - 1
+            else:
+                continue
+            rows.append({"case": case, "metric": metric, "baseline": base_value, "current": metrics[metric],
+                         "change": change, "regression": change > tolerance})
+    return pd.DataFrame(rows, columns=["case", "metric", "baseline", "current", "change", "regression"])
+
+# run_benchmark_suite(dataset_dir, "bench/pipeline.json")
+# run_benchmark_suite(dataset_dir, "bench/pipeline_new.json", baseline_path="bench/pipeline.json")
 
-combined_df.to_csv("combined_metrics.csv", index=False)
+runs_dir = "/content/runs"
+metrics_store_dir = "/content/metrics_store"
+ingest_event_logs(runs_dir, metrics_store_dir)
+combined_df = query_metrics(metrics_store_dir, splits=["train", "val"])
+# plot_loss_vs_width(loss_vs_width(metrics_store_dir))
 
 combined_df
 